@@ -0,0 +1,120 @@
+__Author__ = "Vincent Lamy"
+__version__ = "2021.0924"
+
+import argparse
+import tracemalloc
+from q_functions import *
+from q_fake_rest import FakeCluster, FakeRestClient, build_estate
+
+
+# Parse command line
+parser = argparse.ArgumentParser(description='Measure q-replicate-config.py synchronizations against simulated '
+                                             'clusters, no Qumulo cluster is needed')
+parser.add_argument('--relationships', type=int, default=50, help='number of replicated paths')
+parser.add_argument('--targets', type=int, default=1, help='number of target clusters each path is replicated to')
+parser.add_argument('--quotas', type=int, default=5000, help='number of quotas on the primary cluster')
+parser.add_argument('--exports', type=int, default=500, help='number of NFS exports on the primary cluster')
+parser.add_argument('--shares', type=int, default=500, help='number of SMB shares on the primary cluster')
+parser.add_argument('--users', type=int, default=50, help='number of LOCAL users on the primary cluster')
+parser.add_argument('--in-sync', type=float, default=0.0,
+                    help='share of objects already replicated on the secondary cluster, between 0 and 1')
+parser.add_argument('--latency', type=float, default=0.0, help='seconds spent by each REST call')
+parser.add_argument('--error-rate', type=float, default=0.0, help='share of REST calls failing with a 503 error')
+parser.add_argument('--cycles', type=int, default=2,
+                    help='number of synchronizations, the first one is cold, the next ones are steady state')
+parser.add_argument('--settings', default='{}',
+                    help='JSON object overriding settings of credentials.json, e.g. {"replication_workers": 8}')
+parser.add_argument('--seed', type=int, default=0, help='seed of the simulated estate and errors')
+parser.add_argument('--json', action='store_true', help='print the report as JSON')
+args = parser.parse_args()
+
+# Build simulated clusters, relationships only target known target clusters so nothing is probed
+primary = FakeCluster('primary-cluster', '10.0.0.1', args.latency, args.error_rate, args.seed)
+secondaries = [FakeCluster('secondary-cluster-{}'.format(i), '10.0.{}.1'.format(i + 1), args.latency,
+                           args.error_rate, args.seed + i + 1) for i in range(args.targets)]
+build_estate(primary, secondaries, args.relationships, args.quotas, args.shares, args.exports, args.users,
+             args.in_sync, args.seed)
+
+# Versions, caches and metrics on disk are left out, they would be shared with real runs
+json_object = {'primary_cluster_address': primary.address, 'primary_port_number': 8000,
+               'primary_username': 'admin', 'primary_password': 'admin',
+               'secondary_cluster_address': secondaries[0].address, 'secondary_port_number': 8000,
+               'secondary_username': 'admin', 'secondary_password': 'admin',
+               'targets': [{'cluster_address': secondary.address, 'port_number': 8000, 'username': 'admin',
+                            'password': 'admin'} for secondary in secondaries[1:]],
+               'write_snapshots': False, 'path_cache_ttl': 0, 'cluster_cache_ttl': 0,
+               'metrics_file': ''}
+json_object.update(json.loads(args.settings))
+settings = load_settings(json_object)
+
+# Logging Details, the benchmark has its own log file to keep q-replicate-config.log for real runs
+log_pipeline = LogPipeline('q-benchmark.log', settings)
+
+prc = FakeRestClient(primary)
+prc.login('admin', 'admin')
+target_sessions = []
+for target, secondary in zip(load_targets(json_object), secondaries):
+    src = FakeRestClient(secondary)
+    src.login(target['username'], target['password'])
+    target_sessions.append((target, src))
+
+
+# Returns REST calls made on cluster since calls_before, per endpoint
+def calls_since(cluster, calls_before):
+    return {endpoint: count - calls_before.get(endpoint, 0) for endpoint, count in sorted(cluster.calls.items())
+            if count > calls_before.get(endpoint, 0)}
+
+
+report = {'estate': {'relationships': args.relationships, 'targets': args.targets, 'quotas': args.quotas, 'exports': args.exports,
+                     'shares': args.shares, 'users': args.users, 'in_sync': args.in_sync,
+                     'latency': args.latency, 'error_rate': args.error_rate},
+          'settings': settings, 'cycles': []}
+tracemalloc.start()
+state = SyncState(prc, target_sessions, logging, settings)
+log_pipeline.handler.phase = state.metrics.current_phase
+for cycle in range(args.cycles):
+    primary_before = dict(primary.calls)
+    secondaries_before = [dict(secondary.calls) for secondary in secondaries]
+    tracemalloc.reset_peak()
+    started = time.monotonic()
+    try:
+        counts = sync_cycle(state, 'benchmark-{}'.format(cycle))
+        phases = state.last_metrics['phases']
+        error = None
+    except (Exception, SystemExit) as err:
+        counts = {}
+        phases = {}
+        error = repr(err)
+        state.reset()
+    elapsed = time.monotonic() - started
+    actions = {name.replace('|', ' '): count for name, count in counts.items()}
+    primary_calls = calls_since(primary, primary_before)
+    secondary_calls = {}
+    for secondary, secondary_before in zip(secondaries, secondaries_before):
+        for endpoint, count in calls_since(secondary, secondary_before).items():
+            secondary_calls[endpoint] = secondary_calls.get(endpoint, 0) + count
+    report['cycles'].append({'cycle': cycle, 'seconds': round(elapsed, 3), 'error': error,
+                             'peak_memory_mb': round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1),
+                             'phases': phases,
+                             'results': dict(sorted(actions.items())),
+                             'primary_calls': primary_calls, 'secondary_calls': secondary_calls,
+                             'total_calls': sum(primary_calls.values()) + sum(secondary_calls.values())})
+tracemalloc.stop()
+log_pipeline.close()
+
+if args.json:
+    print(json.dumps(report, indent=2))
+else:
+    print('Estate : {relationships} relationships to {targets} targets, {quotas} quotas, {exports} exports, {shares} shares, '
+          '{users} users, {latency}s latency, {error_rate} error rate'.format(**report['estate']))
+    for cycle in report['cycles']:
+        print('Cycle {cycle} : {seconds}s, {total_calls} REST calls, {peak_memory_mb} MB peak memory'.format(**cycle))
+        print('    phases : {}'.format(', '.join('{} {}s'.format(phase, seconds)
+                                                for phase, seconds in cycle['phases'].items())))
+        if cycle['error']:
+            print('    failed : {}'.format(cycle['error']))
+        for name, count in cycle['results'].items():
+            print('    {:32} {}'.format(name, count))
+        for cluster in ('primary', 'secondary'):
+            for endpoint, count in cycle['{}_calls'.format(cluster)].items():
+                print('    {:10} {:48} {}'.format(cluster, endpoint, count))
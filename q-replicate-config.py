@@ -1,12 +1,30 @@
 __Author__ = "Vincent Lamy"
 __version__ = "2021.0924"
 
+import argparse
 from q_functions import *
 
 
-# Logging Details
-logging.basicConfig(filename='q-replicate-config.log', level=logging.INFO,
-                    format='%(asctime)s,%(levelname)s,%(message)s')
+# Parse command line
+parser = argparse.ArgumentParser(description='Replicate SMB/NFS/Quotas config from Qumulo to Qumulo, '
+                                             'based on replication policies')
+parser.add_argument('--daemon', action='store_true',
+                    help='keep running and synchronize again every sync_interval seconds')
+parser.add_argument('--plan', nargs='?', const='q-replicate-config-plan.json', metavar='FILE',
+                    help='only print what a synchronization would change and its estimated cost, nothing is '
+                         'written on the target clusters, the detailed plan is written as JSON to FILE '
+                         '(default q-replicate-config-plan.json)')
+parser.add_argument('--types', nargs='+', choices=OBJECT_TYPES, metavar='TYPE',
+                    help='only synchronize these object types (quotas, nfs, smb), overrides sync_types')
+parser.add_argument('--paths', nargs='+', metavar='PATTERN',
+                    help='only synchronize the replicated paths of the primary cluster matching these glob patterns, '
+                         'e.g. /projects/*, overrides sync_paths')
+parser.add_argument('--verify', action='store_true',
+                    help='compare every object with the target clusters, even the ones unchanged since they were '
+                         'last verified (fingerprint_ttl)')
+parser.add_argument('--resume', action='store_true',
+                    help='resume an interrupted run, objects it already wrote and still as written are skipped')
+args = parser.parse_args()
 
 # Create timestamp for naming pattern
 now = datetime.now()
@@ -24,11 +42,19 @@ primary_port_number = json_object['primary_port_number']
 primary_username = json_object['primary_username']
 primary_password = json_object['primary_password']
 
-# Parse secondary cluster credentials
-secondary_cluster_address = json_object['secondary_cluster_address']
-secondary_port_number = json_object['secondary_port_number']
-secondary_username = json_object['secondary_username']
-secondary_password = json_object['secondary_password']
+# Parse target clusters credentials, the secondary cluster and the ones listed in targets
+targets = load_targets(json_object)
+
+# Parse optional tuning settings
+settings = load_settings(json_object)
+if args.types:
+    settings['sync_types'] = args.types
+if args.paths:
+    settings['sync_paths'] = args.paths
+
+# Logging Details, records are written to q-replicate-config.log in the background (log_format, object_log_level,
+# log_noop_sample)
+log_pipeline = LogPipeline('q-replicate-config.log', settings)
 
 # Connect to the primary cluster
 try:
@@ -42,105 +68,60 @@ except Exception as err:
     logging.info('main,  Ending program now')
     quit()
 
-# Connect to the secondary cluster
-try:
-    src = RestClient(secondary_cluster_address, secondary_port_number)
-    src.login(secondary_username, secondary_password)
-    logging.info('main,  Connection established with {}'.format(secondary_cluster_address))
-except Exception as err:
-    logging.info('main,  Connection cannot be established with {}'.format(secondary_cluster_address))
-    logging.info(
-        'Error message is {}'.format(err.__dict__))
-    logging.info('main,  Ending program now')
+# Connect to the target clusters, unreachable ones are connected again before each synchronization
+target_sessions = [(target, connect_target(target, logging)) for target in targets]
+if not args.daemon and all(src is None for target, src in target_sessions):
+    logging.info('main,  No target cluster can be reached, ending program now')
     quit()
 
-# Get All Replication configured on primary cluster
-all_repl = prc.replication.list_source_relationship_statuses()
-tgt_cluster_id = get_cluster_id(src, logging)
-
-# Extract only replication where target is secondary cluster
-path_lst = []
-path_translation = {}
-for repl in all_repl:
-    test_repl = is_ip_on_cluster(tgt_cluster_id, repl['target_address'], secondary_port_number,
-                                 secondary_username, secondary_password, logging)
-    if test_repl:
-        logging.info(
-            'main,  Replication id {} has target ip {} and will be processed'.format(repl['id'],
-                                                                                     repl['target_address']))
-        # Retrieve source path
-
-        path_lst.append(repl['source_root_path'])
-        path_translation[repl['source_root_path']] = repl['target_root_path']
-        logging.info(
-            'main, Source path to be processed is {} and its target path is {}'.format(repl['source_root_path'],
-                                                                                       repl['target_root_path']))
-    else:
-        logging.info(
-            'main,  Replication id {} has target ip {} and won\'t processed'.format(repl['id'], repl['target_address']))
-
-# Retrieve SMB shares, NFS exports and quotas related to each source path in path_lst
-# Generates 3 json files for SMB, NFS and Quotas
-
-for path in path_lst:
-    # Filenames pattern will refer the actual path
-    smb_file = './smb' + path.rstrip(path[-1]).replace('/', '-') + '.json'
-    nfs_file = './nfs' + path.rstrip(path[-1]).replace('/', '-') + '.json'
-    quotas_file = './quotas' + path.rstrip(path[-1]).replace('/', '-') + '.json'
-    # If files already exists, remove them and log a message
-    if os.path.exists(smb_file):
-        os.remove(smb_file)
-        logging.info(
-            'main,  File {} already exists --> we removed it'.format(smb_file))
-    if os.path.exists(nfs_file):
-        os.remove(nfs_file)
-        logging.info(
-            'main,  File {} already exists --> we removed it'.format(nfs_file))
-    if os.path.exists(quotas_file):
-        os.remove(quotas_file)
-        logging.info(
-            'main,  File {} already exists --> we removed it'.format(quotas_file))
-
-    # Get SMB Shares related to this path
-    smb_shares = get_smb_shr(prc, src, logging, path)
-    f = open(smb_file, "w")
-    f.write(smb_shares)
-    f.close()
-
-
-    # Get NFS exports related to this path
-    nfs_exports = get_nfs_exp(prc, logging, path)
-    f = open(nfs_file, "w")
-    f.write(nfs_exports)
-    f.close()
-
-    # Get Quotas to replicate
-    quotas = get_quotas(prc, logging, path)
-    f = open(quotas_file, "w")
-    f.write(quotas)
-    f.close()
-
-    replicate_quotas(prc, src, logging, quotas_file, path_translation, date_suffix)
-    replicate_nfs(src, logging, nfs_file, path_translation, date_suffix)
-    replicate_smb(src, logging, smb_file, path_translation, date_suffix)
-
-    # Clean temporary files
-    if os.path.exists(smb_file):
-        os.remove(smb_file)
-        logging.info(
-            'main,  Temporary file {} has been removed'.format(smb_file))
-    if os.path.exists(nfs_file):
-        os.remove(nfs_file)
-        logging.info(
-            'main,  Temporary file {} has been removed'.format(nfs_file))
-    if os.path.exists(quotas_file):
-        os.remove(quotas_file)
-        logging.info(
-            'main,  Temporary file {} has been removed'.format(quotas_file))
-
+# Sessions, caches and relationships are kept between synchronizations
+state = SyncState(prc, target_sessions, logging, settings, lambda target: connect_target(target, logging))
+state.resume = args.resume
+state.verify = args.verify
+# Records carry the phase they were logged in
+log_pipeline.handler.phase = state.metrics.current_phase
+
+if args.plan:
+    # Build the plan of a synchronization, nothing is written on the target clusters
+    try:
+        plan = plan_cycle(state, date_suffix)
+        with open(args.plan, 'w') as plan_file:
+            json.dump(plan, plan_file, indent=2)
+        print(plan_summary(plan))
+        print('Detailed plan written to {}'.format(args.plan))
+    except ReplicationError as err:
+        logging.error('main,  Plan failed, error message is {}'.format(err))
+        print('Plan failed : {}'.format(err))
+elif args.daemon:
+    # Synchronize every sync_interval seconds until interrupted
+    logging.info('main,  Running as a daemon, synchronizing every {} seconds'.format(settings['sync_interval']))
+    try:
+        while True:
+            started = time.monotonic()
+            try:
+                sync_cycle(state, datetime.now().strftime("%Y%m%d-%H%M%S"))
+            except Exception as err:
+                logging.error('main,  Synchronization failed, everything will be retrieved again next time')
+                logging.error('main,  Error message is {}'.format(err))
+                state.reset()
+                # Sessions may have expired, log in again
+                try:
+                    state.login(primary_username, primary_password)
+                except Exception as err:
+                    logging.error('main,  Can not log in again, error message is {}'.format(err))
+            time.sleep(max(0, settings['sync_interval'] - (time.monotonic() - started)))
+    except KeyboardInterrupt:
+        logging.info('main,  Daemon interrupted')
+else:
+    try:
+        sync_cycle(state, date_suffix)
+    except ReplicationError as err:
+        logging.error('main,  Synchronization failed, error message is {}'.format(err))
+        logging.info('main,  Ending program now')
 
 # Closing connection to clusters
-prc.close()
-src.close()
+state.close()
 logging.info('main,  Connection ended with {}'.format(primary_cluster_address))
-logging.info('main,  Connection ended with {}'.format(secondary_cluster_address))
+for target in state.targets:
+    logging.info('main,  Connection ended with {}'.format(target.address))
+log_pipeline.close()
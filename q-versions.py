@@ -0,0 +1,74 @@
+__Author__ = "Vincent Lamy"
+__version__ = "2021.0924"
+
+import argparse
+from q_functions import *
+
+
+# Logging Details
+logging.basicConfig(filename='q-replicate-config.log', level=logging.INFO,
+                    format='%(asctime)s,%(levelname)s,%(message)s')
+
+parser = argparse.ArgumentParser(description='Query the configuration versions recorded by q-replicate-config.py')
+parser.add_argument('--target', help='cluster id of an additional target cluster, its runs are in '
+                                    './versions-<cluster id>, runs of the secondary cluster are in ./versions')
+commands = parser.add_subparsers(dest='command', required=True)
+commands.add_parser('list', help='list recorded runs')
+diff_parser = commands.add_parser('diff', help='show what changed between two runs (run ids, latest or previous)')
+diff_parser.add_argument('old_run')
+diff_parser.add_argument('new_run', nargs='?', default='latest')
+diff_parser.add_argument('--details', action='store_true', help='print old and new content of changed objects')
+show_parser = commands.add_parser('show', help='print the objects recorded by a run')
+show_parser.add_argument('run', nargs='?', default='latest')
+show_parser.add_argument('--type', choices=['quotas', 'nfs', 'smb'], help='only print this object type')
+show_parser.add_argument('--root', help='only print objects of this replicated path')
+compact_parser = commands.add_parser('compact', help='apply a retention policy and remove unreferenced objects')
+compact_parser.add_argument('--keep-runs', type=int, default=0, help='number of most recent runs to keep')
+compact_parser.add_argument('--keep-days', type=int, default=0, help='remove runs older than this number of days')
+args = parser.parse_args()
+
+store = SnapshotStore(logging, './versions-{}'.format(args.target) if args.target else './versions')
+runs = store.list_runs()
+
+
+# Accept latest and previous in place of a run id
+def run_id(name):
+    aliases = {'latest': -1, 'previous': -2}
+    if name in aliases:
+        if len(runs) < -aliases[name]:
+            parser.error('not enough recorded runs for {}'.format(name))
+        return runs[aliases[name]]
+    if name not in runs:
+        parser.error('unknown run {}'.format(name))
+    return name
+
+
+if args.command == 'list':
+    for run in runs:
+        print('{}  {} objects'.format(run, len(store.get_run(run))))
+
+elif args.command == 'diff':
+    old_run = run_id(args.old_run)
+    new_run = run_id(args.new_run)
+    changes = store.diff_runs(old_run, new_run)
+    for change in ('added', 'removed', 'changed'):
+        for key in sorted(changes[change]):
+            print('{:8} {}'.format(change, key.replace('|', ' ')))
+            if args.details and change == 'changed':
+                old_digest, new_digest = changes[change][key]
+                print('    old : {}'.format(json.dumps(store.get_object(old_digest), sort_keys=True)))
+                print('    new : {}'.format(json.dumps(store.get_object(new_digest), sort_keys=True)))
+    print('{} added, {} removed, {} changed between {} and {}'.format(
+        len(changes['added']), len(changes['removed']), len(changes['changed']), old_run, new_run))
+
+elif args.command == 'show':
+    for key, digest in sorted(store.get_run(run_id(args.run)).items()):
+        object_type, root, object_key = key.split('|', 2)
+        if (args.type is None or args.type == object_type) and (args.root is None or args.root == root):
+            print(json.dumps({'type': object_type, 'root': root, 'key': object_key, 'data': store.get_object(digest)},
+                             sort_keys=True))
+
+elif args.command == 'compact':
+    removed_runs = store.apply_retention(args.keep_runs, args.keep_days)
+    removed_objects = store.compact()
+    print('{} runs and {} objects removed'.format(removed_runs, removed_objects))
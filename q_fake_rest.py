@@ -0,0 +1,370 @@
+__Author__ = "Vincent Lamy"
+__version__ = "2021.0924"
+import time
+import bisect
+import random
+import threading
+from qumulo.rest_client import RestClient
+
+
+# In-memory stand-in for the part of a Qumulo cluster used by q_functions, to measure a run without a cluster
+# Every REST call is counted per endpoint, waits latency seconds and fails with a 503 error with probability
+# error_rate, like a loaded cluster would
+class FakeCluster:
+    def __init__(self, cluster_id, address, latency=0.0, error_rate=0.0, seed=None):
+        self.cluster_id = cluster_id
+        self.address = address
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.last_id = 1000
+        # id -> path and path -> id of directories, the root directory always exists
+        self.dirs = {'2': '/'}
+        self.paths = {'/': '2'}
+        # directory id -> limit, export id -> export, share id -> share, auth_id -> local user
+        self.quotas = {}
+        self.exports = {}
+        self.shares = {}
+        self.users = {}
+        self.relationships = []
+
+    # Count a call to endpoint, then wait and fail like the cluster would
+    # Logins never fail, the ones made before sessions are wrapped in a transport are not retried
+    def call(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+            failed = self.error_rate and endpoint != 'auth.login' and self.random.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            raise RestClient.Error(503, 'Service Unavailable')
+
+    def new_id(self):
+        with self.lock:
+            self.last_id += 1
+            return str(self.last_id)
+
+    # Create a directory and its parents, returns the directory id
+    def mkdir(self, path):
+        parts = [part for part in path.split('/') if part]
+        path = '/' + ''.join(part + '/' for part in parts)
+        if path in self.paths:
+            return self.paths[path]
+        self.mkdir(path[:path.rstrip('/').rfind('/') + 1])
+        dir_id = self.new_id()
+        self.dirs[dir_id] = path
+        self.paths[path] = dir_id
+        return dir_id
+
+    def add_user(self, name):
+        auth_id = self.new_id()
+        self.users[auth_id] = {'auth_id': auth_id, 'domain': 'LOCAL', 'name': name,
+                               'sid': 'S-1-5-21-{}-{}'.format(self.cluster_id, auth_id)}
+        return self.users[auth_id]
+
+    def not_found(self):
+        raise RestClient.Error(404, 'Not Found')
+
+
+# Namespace of REST modules of a FakeRestClient
+class FakeModule:
+    def __init__(self, cluster):
+        self.cluster = cluster
+
+
+class FakeReplication(FakeModule):
+    def list_source_relationship_statuses(self):
+        self.cluster.call('replication.list_source_relationship_statuses')
+        return [dict(repl) for repl in self.cluster.relationships]
+
+
+class FakeNodeState(FakeModule):
+    def get_node_state(self):
+        self.cluster.call('node_state.get_node_state')
+        return {'cluster_id': self.cluster.cluster_id, 'node_id': 1, 'state': 'ACTIVE'}
+
+
+class FakeAuth(FakeModule):
+    def login(self, username, password):
+        self.cluster.call('auth.login')
+        return {'bearer_token': 'fake-{}'.format(self.cluster.cluster_id)}
+
+    def find_identity(self, **attrs):
+        self.cluster.call('auth.find_identity')
+        for user in self.cluster.users.values():
+            if attrs.get('auth_id') == user['auth_id'] or attrs.get('name') == user['name']:
+                return dict(user)
+        self.cluster.not_found()
+
+
+class FakeUsers(FakeModule):
+    def list_users(self):
+        self.cluster.call('users.list_users')
+        return [{'id': user['auth_id'], 'name': user['name'], 'sid': user['sid']}
+                for user in self.cluster.users.values()]
+
+
+class FakeGroups(FakeModule):
+    def list_groups(self):
+        self.cluster.call('groups.list_groups')
+        return []
+
+
+class FakeFs(FakeModule):
+    def get_file_attr(self, id_=None, path=None):
+        self.cluster.call('fs.get_file_attr')
+        # Like the real client, the first positional argument is an id
+        file_id = id_ if id_ in self.cluster.dirs else self.cluster.paths.get(path or id_)
+        if file_id is None:
+            self.cluster.not_found()
+        return {'id': file_id, 'path': self.cluster.dirs[file_id], 'type': 'FS_FILE_TYPE_DIRECTORY'}
+
+    def resolve_paths(self, ids):
+        self.cluster.call('fs.resolve_paths')
+        return [{'id': file_id, 'path': self.cluster.dirs.get(file_id, '')} for file_id in ids]
+
+
+class FakeQuota(FakeModule):
+    # Page of quotas after the directory id after, in directory id order like the cluster
+    def page(self, page_size, after=None):
+        dir_ids = sorted(map(int, self.cluster.quotas))
+        dir_ids = dir_ids[bisect.bisect_right(dir_ids, int(after)) if after is not None else 0:]
+        quotas = [{'id': str(dir_id), 'limit': self.cluster.quotas[str(dir_id)]} for dir_id in dir_ids[:page_size]]
+        next_uri = None
+        if len(dir_ids) > page_size:
+            next_uri = '/v1/files/quotas/?after={}&limit={}'.format(quotas[-1]['id'], page_size)
+        return {'quotas': quotas, 'paging': {'next': next_uri}}
+
+    def get_all_quotas(self, page_size=None):
+        after = None
+        while True:
+            self.cluster.call('quota.get_all_quotas')
+            page = self.page(page_size or 1000, after)
+            yield page
+            if page['paging']['next'] is None:
+                return
+            after = page['quotas'][-1]['id']
+
+    def get_quota_with_status(self, id_):
+        self.cluster.call('quota.get_quota_with_status')
+        if id_ not in self.cluster.quotas:
+            self.cluster.not_found()
+        return {'id': id_, 'limit': self.cluster.quotas[id_], 'path': self.cluster.dirs[id_], 'capacity_usage': '0'}
+
+    def create_quota(self, id_, limit_in_bytes):
+        self.cluster.call('quota.create_quota')
+        if id_ not in self.cluster.dirs or id_ in self.cluster.quotas:
+            raise RestClient.Error(409 if id_ in self.cluster.quotas else 404, 'Conflict')
+        self.cluster.quotas[id_] = str(limit_in_bytes)
+        return {'id': id_, 'limit': str(limit_in_bytes)}
+
+    def update_quota(self, id_, limit_in_bytes):
+        self.cluster.call('quota.update_quota')
+        if id_ not in self.cluster.quotas:
+            self.cluster.not_found()
+        self.cluster.quotas[id_] = str(limit_in_bytes)
+        return {'id': id_, 'limit': str(limit_in_bytes)}
+
+    def delete_quota(self, id_):
+        self.cluster.call('quota.delete_quota')
+        if self.cluster.quotas.pop(id_, None) is None:
+            self.cluster.not_found()
+
+
+# Restrictions may be sent as NFSExportRestriction objects or as dicts
+def restriction_dict(restriction):
+    return restriction.dictionary() if hasattr(restriction, 'dictionary') else dict(restriction)
+
+
+class FakeNfs(FakeModule):
+    def nfs_list_exports(self):
+        self.cluster.call('nfs.nfs_list_exports')
+        return [dict(export) for export in self.cluster.exports.values()]
+
+    def nfs_get_export(self, export_id):
+        self.cluster.call('nfs.nfs_get_export')
+        for export in self.cluster.exports.values():
+            if export_id in (export['id'], export['export_path']):
+                return dict(export)
+        self.cluster.not_found()
+
+    def nfs_add_export(self, export_path, fs_path, description, restrictions, fields_to_present_as_32_bit=None):
+        self.cluster.call('nfs.nfs_add_export')
+        if any(export['export_path'] == export_path for export in self.cluster.exports.values()):
+            raise RestClient.Error(409, 'Conflict')
+        export_id = self.cluster.new_id()
+        self.cluster.exports[export_id] = {
+            'id': export_id, 'export_path': export_path, 'fs_path': fs_path, 'description': description,
+            'restrictions': [restriction_dict(restriction) for restriction in restrictions],
+            'fields_to_present_as_32_bit': fields_to_present_as_32_bit or []}
+        return dict(self.cluster.exports[export_id])
+
+    def nfs_modify_export(self, id_, export_path, fs_path, description, restrictions,
+                          fields_to_present_as_32_bit=None):
+        self.cluster.call('nfs.nfs_modify_export')
+        if id_ not in self.cluster.exports:
+            self.cluster.not_found()
+        self.cluster.exports[id_].update(
+            export_path=export_path, fs_path=fs_path, description=description,
+            restrictions=[restriction_dict(restriction) for restriction in restrictions],
+            fields_to_present_as_32_bit=fields_to_present_as_32_bit or [])
+        return dict(self.cluster.exports[id_])
+
+    def nfs_delete_export(self, export_id):
+        self.cluster.call('nfs.nfs_delete_export')
+        if self.cluster.exports.pop(export_id, None) is None:
+            self.cluster.not_found()
+
+
+# Fields of a share stored by the fake cluster
+SHARE_FIELDS = ('fs_path', 'description', 'access_based_enumeration_enabled', 'default_file_create_mode',
+                'default_directory_create_mode', 'permissions', 'require_encryption', 'network_permissions')
+
+
+class FakeSmb(FakeModule):
+    def find(self, share_name):
+        for share in self.cluster.shares.values():
+            if share_name in (share['id'], share['share_name']):
+                return share
+        self.cluster.not_found()
+
+    def smb_list_shares(self):
+        self.cluster.call('smb.smb_list_shares')
+        return [dict(share) for share in self.cluster.shares.values()]
+
+    def smb_list_share(self, share_id):
+        self.cluster.call('smb.smb_list_share')
+        return dict(self.find(share_id))
+
+    def smb_add_share(self, share_name, **fields):
+        self.cluster.call('smb.smb_add_share')
+        if any(share['share_name'] == share_name for share in self.cluster.shares.values()):
+            raise RestClient.Error(409, 'Conflict')
+        share_id = self.cluster.new_id()
+        self.cluster.shares[share_id] = dict({field: fields.get(field) for field in SHARE_FIELDS},
+                                             id=share_id, share_name=share_name)
+        return dict(self.cluster.shares[share_id])
+
+    def smb_modify_share(self, old_name, **fields):
+        self.cluster.call('smb.smb_modify_share')
+        share = self.find(old_name)
+        share.update({field: fields[field] for field in SHARE_FIELDS if field in fields})
+        return dict(share)
+
+    def smb_delete_share(self, share_id):
+        self.cluster.call('smb.smb_delete_share')
+        share = self.find(share_id)
+        del self.cluster.shares[share['id']]
+
+
+class FakeConnInfo:
+    def __init__(self, host, port, credentials):
+        self.host = host
+        self.port = port
+        self.credentials = credentials
+
+
+# Drop-in replacement of RestClient talking to a FakeCluster
+class FakeRestClient:
+    def __init__(self, cluster, port=8000, credentials=None):
+        self.cluster = cluster
+        self.conninfo = FakeConnInfo(cluster.address, port, credentials)
+        self.replication = FakeReplication(cluster)
+        self.node_state = FakeNodeState(cluster)
+        self.auth = FakeAuth(cluster)
+        self.users = FakeUsers(cluster)
+        self.groups = FakeGroups(cluster)
+        self.fs = FakeFs(cluster)
+        self.quota = FakeQuota(cluster)
+        self.nfs = FakeNfs(cluster)
+        self.smb = FakeSmb(cluster)
+
+    def login(self, username, password):
+        self.conninfo.credentials = self.auth.login(username, password)
+        return self.conninfo.credentials
+
+    def clone(self):
+        return FakeRestClient(self.cluster, self.conninfo.port, self.conninfo.credentials)
+
+    # Raw requests, only the quotas listing is simulated
+    def request(self, method, uri):
+        path, _, query = uri.partition('?')
+        if method != 'GET' or path != '/v1/files/quotas/':
+            raise RestClient.Error(404, 'Not Found')
+        params = dict(param.split('=', 1) for param in query.split('&') if param)
+        self.cluster.call('quota.get_all_quotas')
+        return self.quota.page(int(params.get('limit', 1000)), params.get('after'))
+
+    def close(self):
+        pass
+
+
+# Fill a primary FakeCluster with local users and quotas, NFS exports and SMB shares evenly spread under
+# replicated paths, every replicated path is replicated to each of the secondary clusters
+# in_sync is the share of objects already replicated as is on each secondary cluster
+def build_estate(primary, secondaries, relationships=500, quotas=50000, shares=5000, exports=5000, users=50,
+                 in_sync=0.0, seed=0):
+    rnd = random.Random(seed)
+    src_users = [primary.add_user('user{}'.format(i)) for i in range(users)]
+    # One user out of ten only exists on the primary cluster
+    tgt_users = [{user['name']: secondary.add_user(user['name']) for user in src_users[:users - users // 10]}
+                 for secondary in secondaries]
+    roots = []
+    for i in range(relationships):
+        src_root = '/data{}/'.format(i)
+        dst_root = '/dr/data{}/'.format(i)
+        primary.mkdir(src_root)
+        for secondary in secondaries:
+            secondary.mkdir(dst_root)
+            primary.relationships.append({'id': 'repl-{}-{}'.format(secondary.cluster_id, i),
+                                          'target_address': secondary.address,
+                                          'source_root_path': src_root, 'target_root_path': dst_root,
+                                          'state': 'ESTABLISHED', 'end_reason': ''})
+        roots.append((src_root, dst_root))
+    for i in range(quotas):
+        src_root, dst_root = roots[i % len(roots)]
+        src_id = primary.mkdir('{}q{}/'.format(src_root, i))
+        primary.quotas[src_id] = str(rnd.randrange(1, 1000) * 2 ** 30)
+        for secondary in secondaries:
+            dst_id = secondary.mkdir('{}q{}/'.format(dst_root, i))
+            if rnd.random() < in_sync:
+                secondary.quotas[dst_id] = primary.quotas[src_id]
+    for i in range(exports):
+        src_root, dst_root = roots[i % len(roots)]
+        export = {'export_path': '/export{}'.format(i), 'fs_path': '{}e{}'.format(src_root, i),
+                  'description': 'export {}'.format(i), 'fields_to_present_as_32_bit': [],
+                  'restrictions': [{'read_only': bool(i % 2), 'require_privileged_port': False,
+                                    'host_restrictions': [], 'user_mapping': 'NFS_MAP_NONE',
+                                    'map_to_user': {'id_type': 'LOCAL_USER', 'id_value': '0'}}]}
+        export_id = primary.new_id()
+        primary.exports[export_id] = dict(export, id=export_id)
+        for secondary in secondaries:
+            if rnd.random() < in_sync:
+                export_id = secondary.new_id()
+                secondary.exports[export_id] = dict(export, id=export_id, fs_path='{}e{}'.format(dst_root, i))
+    for i in range(shares):
+        src_root, dst_root = roots[i % len(roots)]
+        users_on_share = rnd.sample(src_users, min(3, len(src_users)))
+        share = {'share_name': 'share{}'.format(i), 'fs_path': '{}s{}'.format(src_root, i), 'description': '',
+                 'access_based_enumeration_enabled': False, 'default_file_create_mode': '0644',
+                 'default_directory_create_mode': '0755', 'require_encryption': False,
+                 'network_permissions': [{'type': 'ALLOWED', 'address_ranges': [], 'rights': ['READ', 'WRITE']}],
+                 'permissions': [{'type': 'ALLOWED', 'flags': [], 'rights': ['READ'],
+                                  'trustee': {'domain': 'WORLD', 'auth_id': '8589934592', 'sid': 'S-1-1-0'}}] +
+                                [{'type': 'ALLOWED', 'flags': [], 'rights': ['READ', 'WRITE'],
+                                  'trustee': {'domain': 'LOCAL', 'auth_id': user['auth_id'], 'sid': user['sid']}}
+                                 for user in users_on_share]}
+        share_id = primary.new_id()
+        primary.shares[share_id] = dict(share, id=share_id)
+        for secondary, secondary_users in zip(secondaries, tgt_users):
+            if rnd.random() < in_sync:
+                share_id = secondary.new_id()
+                permissions = [dict(ace, trustee=dict(ace['trustee'],
+                                                      auth_id=secondary_users[user['name']]['auth_id'],
+                                                      sid=secondary_users[user['name']]['sid']))
+                               for ace, user in zip(share['permissions'][1:], users_on_share)
+                               if user['name'] in secondary_users]
+                secondary.shares[share_id] = dict(share, id=share_id, fs_path='{}s{}'.format(dst_root, i),
+                                                  permissions=share['permissions'][:1] + permissions)
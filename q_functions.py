@@ -1,40 +1,358 @@
 __Author__ = "Vincent Lamy"
 __version__ = "2021.0924"
 import os
+import gzip
 import json
-import shutil
+import fnmatch
+import queue
+import random
+import time
+import hashlib
+import http.client
+import atexit
 import qumulo
 import logging
+import logging.handlers
+import threading
 from datetime import datetime
+from collections import namedtuple
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
 from qumulo.rest_client import RestClient
 
 
-# handling file versions
-def archive_file(filename, logging, date_suffix):
-    # Check if version directory exists and creates it if needed
-    if not os.path.isdir("./versions"):
-        os.mkdir("./versions")
-        logging.info('archive_file, directory versions did not exists - creating it')
-    # Copy renamed file to version directory
-    # Removing ./ from filename for easier manipulation
-    filename = filename[2:]
-    new_filename = filename + "-" + date_suffix
-    latest_filename = filename + "-latest"
-    shutil.copy2(filename, './versions/{}'.format(new_filename))
-    logging.info('archive_file, Archiving file ./{} to ./versions/{}'.format(filename, new_filename))
-    # Check if symlink to latest version exists
-    if os.path.islink('./versions/{}'.format(latest_filename)):
-        # Retrieve symlink target to delete old file
-        file_to_del = os.readlink('./versions/{}'.format(latest_filename))
-        # update the symlink - delete and recreate - then remove old file
-        os.unlink('./versions/{}'.format(latest_filename))
-        os.symlink('./{}'.format(new_filename),'./versions/{}'.format(latest_filename))
-        os.remove('./versions/{}'.format(file_to_del))
-        logging.info('archive_file, File ./versions/{} has been removed'.format(file_to_del))
-    else:
-        # Create the symlink
-        print('Create SymLink {} to {}'.format(latest_filename,new_filename))
-        os.symlink('./{}'.format(new_filename),'./versions/{}'.format(latest_filename))
+# Record flowing from the gather stage to the replication stage
+# object_type is quotas, nfs or smb, root is the replicated source path, key identifies the object on the target
+# (quota path, export path or share name) and path is its source filesystem path
+ConfigRecord = namedtuple('ConfigRecord', 'object_type root key path data')
+# Object types replicated
+OBJECT_TYPES = ('quotas', 'nfs', 'smb')
+
+
+# Versioned store of the replicated configuration in ./versions
+# Every object is stored once, gzipped, under objects/<hash[:2]>/<hash>.json.gz where hash is the sha256 of its
+# canonical json, so objects unchanged between runs cost nothing. Each run only writes a manifest in
+# runs/<run_id>.json.gz mapping "object_type|root|key" to the hash of the object
+class SnapshotStore:
+    def __init__(self, logging, path='./versions'):
+        self.logging = logging
+        self.path = path
+        os.makedirs(os.path.join(path, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(path, 'runs'), exist_ok=True)
+
+    def _object_file(self, digest):
+        return os.path.join(self.path, 'objects', digest[:2], digest + '.json.gz')
+
+    def _run_file(self, run_id):
+        return os.path.join(self.path, 'runs', run_id + '.json.gz')
+
+    # Store an object if it is not already known and returns its hash
+    def put_object(self, data):
+        content = json.dumps(data, sort_keys=True, separators=(',', ':')).encode()
+        digest = hashlib.sha256(content).hexdigest()
+        object_file = self._object_file(digest)
+        if not os.path.exists(object_file):
+            os.makedirs(os.path.dirname(object_file), exist_ok=True)
+            with gzip.open(object_file + '.tmp', 'wb') as f:
+                f.write(content)
+            os.replace(object_file + '.tmp', object_file)
+        return digest
+
+    def get_object(self, digest):
+        with gzip.open(self._object_file(digest), 'rb') as f:
+            return json.loads(f.read())
+
+    # Write the manifest of a run, entries is a dict "object_type|root|key" -> hash
+    def write_run(self, run_id, entries):
+        with gzip.open(self._run_file(run_id) + '.tmp', 'wt') as f:
+            json.dump({'run': run_id, 'objects': entries}, f, sort_keys=True, separators=(',', ':'))
+        os.replace(self._run_file(run_id) + '.tmp', self._run_file(run_id))
+        self.logging.info('SnapshotStore, Run {} recorded with {} objects'.format(run_id, len(entries)))
+
+    def get_run(self, run_id):
+        with gzip.open(self._run_file(run_id), 'rt') as f:
+            return json.load(f)['objects']
+
+    # Returns the run ids, oldest first
+    def list_runs(self):
+        return sorted(name[:-len('.json.gz')] for name in os.listdir(os.path.join(self.path, 'runs'))
+                      if name.endswith('.json.gz'))
+
+    # Returns what changed between two runs : dicts of added, removed and changed keys
+    def diff_runs(self, old_run, new_run):
+        old_entries = self.get_run(old_run)
+        new_entries = self.get_run(new_run)
+        return {'added': {key: new_entries[key] for key in new_entries.keys() - old_entries.keys()},
+                'removed': {key: old_entries[key] for key in old_entries.keys() - new_entries.keys()},
+                'changed': {key: [old_entries[key], new_entries[key]] for key in new_entries.keys() & old_entries.keys()
+                            if old_entries[key] != new_entries[key]}}
+
+    # Remove the runs beyond the keep_runs most recent ones and the runs older than keep_days
+    # 0 disables the corresponding limit, returns the number of removed runs
+    def apply_retention(self, keep_runs=0, keep_days=0):
+        runs = self.list_runs()
+        to_remove = set(runs[:-keep_runs]) if keep_runs and len(runs) > keep_runs else set()
+        if keep_days:
+            oldest = datetime.now().timestamp() - keep_days * 86400
+            to_remove.update(run_id for run_id in runs if os.path.getmtime(self._run_file(run_id)) < oldest)
+        for run_id in to_remove:
+            os.remove(self._run_file(run_id))
+            self.logging.info('SnapshotStore, Run {} has been removed'.format(run_id))
+        return len(to_remove)
+
+    # Returns True if the last compaction is older than interval seconds
+    def is_compaction_due(self, interval):
+        compacted_file = os.path.join(self.path, 'compacted')
+        return not os.path.exists(compacted_file) or time.time() - os.path.getmtime(compacted_file) >= interval
+
+    # Remove the objects no run refers to any more, returns the number of removed objects
+    # Every remaining run is read, see is_compaction_due
+    def compact(self):
+        referenced = set()
+        for run_id in self.list_runs():
+            referenced.update(self.get_run(run_id).values())
+        removed = 0
+        objects_dir = os.path.join(self.path, 'objects')
+        for prefix in os.listdir(objects_dir):
+            for name in os.listdir(os.path.join(objects_dir, prefix)):
+                if name[:-len('.json.gz')] not in referenced:
+                    os.remove(os.path.join(objects_dir, prefix, name))
+                    removed += 1
+        write_atomically(os.path.join(self.path, 'compacted'), datetime.now().isoformat())
+        self.logging.info('SnapshotStore, {} unreferenced objects removed'.format(removed))
+        return removed
+
+
+# Record the objects gathered during a run in the SnapshotStore from a background thread
+# The run manifest is written on close, then retention is applied and objects are compacted at most once every
+# compact_hours, 0 compacts as soon as runs are removed
+class SnapshotSink:
+    def __init__(self, logging, date_suffix, enabled=True, keep_runs=0, keep_days=0, path='./versions',
+                 compact_hours=0):
+        self.logging = logging
+        self.date_suffix = date_suffix
+        self.enabled = enabled
+        self.keep_runs = keep_runs
+        self.keep_days = keep_days
+        self.compact_hours = compact_hours
+        self.queue = queue.Queue(maxsize=10000)
+        self.entries = {}
+        # Entries of the last recorded run kept as they were, per type|root, see carry
+        self.carried = {}
+        self.previous = None
+        if self.enabled:
+            self.store = SnapshotStore(logging, path)
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    # Pass the records through while queueing them to be stored
+    def tap(self, records):
+        if not self.enabled:
+            yield from records
+            return
+        for record in records:
+            self.queue.put(record)
+            yield record
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            try:
+                key = '{}|{}|{}'.format(record.object_type, record.root, record.key)
+                self.entries[key] = self.store.put_object(record.data)
+            except Exception as err:
+                self.logging.error('SnapshotSink, Can not store {} {}'.format(record.object_type, record.key))
+                self.logging.error('SnapshotSink, Error message is {}'.format(err))
+
+    # Record the objects of a type under a replicated path as they were in the last recorded run, when they were
+    # not retrieved again ; returns False if the last run does not have count objects there, any number of
+    # objects is carried if count is None
+    def carry(self, object_type, root, count=None):
+        if not self.enabled:
+            return True
+        if self.previous is None:
+            runs = self.store.list_runs()
+            self.previous = {}
+            for key, digest in (self.store.get_run(runs[-1]) if runs else {}).items():
+                previous_type, previous_root, object_key = key.split('|', 2)
+                self.previous.setdefault((previous_type, previous_root), {})[key] = digest
+        entries = self.previous.get((object_type, root), {})
+        if count is not None and len(entries) != count:
+            return False
+        self.carried.update(entries)
+        return True
+
+    # Stop storing records without recording the run, objects already stored are removed by the next compaction
+    def discard(self):
+        if self.enabled:
+            self.queue.put(None)
+            self.thread.join()
+
+    # Wait for all queued records to be stored, then record the run
+    def close(self):
+        if not self.enabled:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.store.write_run(self.date_suffix, dict(self.carried, **self.entries))
+        removed = self.store.apply_retention(self.keep_runs, self.keep_days)
+        if (removed or self.compact_hours) and self.store.is_compaction_due(self.compact_hours * 3600):
+            self.store.compact()
+
+
+# Durable record of the objects written on the target clusters during a run, one JSON line per object
+# The journal of a run that did not complete is kept, so the next run can skip the objects it already wrote
+# (--resume) ; it is removed once a run completes on every target
+class RunJournal:
+    def __init__(self, logging, path, sync_every=100):
+        self.logging = logging
+        self.path = path
+        self.sync_every = sync_every
+        self.lock = threading.Lock()
+        self.file = None
+        self.pending = 0
+
+    # Start journaling a run, returns the objects written successfully by the interrupted run if resume is set,
+    # as a dict target cluster id -> {(object_type, root, key): digest of the source record}
+    def start(self, run, resume=False):
+        done = {}
+        if resume and os.path.exists(self.path):
+            with open(self.path) as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Last line of a journal may be incomplete if the run was killed while writing it
+                        continue
+                    if entry.get('status') == 'ok' and entry.get('digest') is not None:
+                        done.setdefault(entry['target'], {})[(entry['type'], entry['root'], entry['key'])] = \
+                            entry['digest']
+            self.logging.info('RunJournal, Resuming interrupted run, {} objects already written'.format(
+                sum(len(entries) for entries in done.values())))
+        elif os.path.exists(self.path):
+            self.logging.info('RunJournal, Previous run was interrupted, starting over (see --resume)')
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, 'a' if done else 'w')
+        self.write({'run': run})
+        return done
+
+    def write(self, entry):
+        with self.lock:
+            self.file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            self.file.flush()
+            self.pending += 1
+            if self.pending >= self.sync_every:
+                os.fsync(self.file.fileno())
+                self.pending = 0
+
+    # Record the outcome of a plan entry applied on the target cluster target_id
+    def record(self, target_id, entry, result):
+        self.write({'target': target_id, 'type': entry['type'], 'root': entry['root'], 'key': entry['key'],
+                    'action': entry['action'], 'status': result['status'], 'digest': entry['digest']})
+
+    # Close the journal, it is removed if the run completed
+    def close(self, completed):
+        if self.file is None:
+            return
+        with self.lock:
+            self.file.close()
+            self.file = None
+        if completed:
+            os.remove(self.path)
+
+
+# Fields of the structured log records, per-object messages set them with extra=
+LOG_FIELDS = ('phase', 'type', 'root', 'key', 'action', 'status', 'seconds')
+# Per-object messages go through this logger so object_log_level only applies to them
+OBJECT_LOGGER = 'q-replicate-config.objects'
+
+
+# Returns the logger of per-object messages, logging is the logging module passed around
+def object_logger(logging):
+    return logging.getLogger(OBJECT_LOGGER)
+
+
+# Format log records as JSON lines with the structured fields they carry
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+                 'level': record.levelname, 'message': record.getMessage()}
+        for field in LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+# Queue log records as they are, their message is only formatted by the writer thread
+# phase, when set, returns the phase of the calling thread (RunMetrics.current_phase) recorded with them
+class AsyncLogHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.phase = None
+
+    def prepare(self, record):
+        if self.phase is not None and getattr(record, 'phase', None) is None:
+            record.phase = self.phase()
+        # Tracebacks can not be formatted once the frames are gone
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+# Keep only a rate share of the records of unchanged objects
+class NoopSampler(logging.Filter):
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return getattr(record, 'action', None) != 'unchanged' or random.random() < self.rate
+
+
+# Returns True if records of unchanged objects logged with log may be kept, so they are not built for nothing
+def is_noop_logged(logging, log):
+    return log.isEnabledFor(logging.INFO) and all(log_filter.rate > 0 for log_filter in log.filters
+                                                  if isinstance(log_filter, NoopSampler))
+
+
+# Log pipeline : records are queued by the calling threads without blocking and written to log_file by a
+# background thread, as text or JSON lines (log_format)
+# Per-object messages are kept from object_log_level and unchanged objects for a log_noop_sample share of them
+class LogPipeline:
+    def __init__(self, log_file, settings, level=logging.INFO):
+        if settings['log_format'] == 'json':
+            formatter = JsonLogFormatter()
+        else:
+            formatter = logging.Formatter('%(asctime)s,%(levelname)s,%(message)s')
+        self.file_handler = logging.FileHandler(log_file)
+        self.file_handler.setFormatter(formatter)
+        self.handler = AsyncLogHandler(queue.SimpleQueue())
+        self.listener = logging.handlers.QueueListener(self.handler.queue, self.file_handler)
+        root = logging.getLogger()
+        root.setLevel(level)
+        root.addHandler(self.handler)
+        objects = logging.getLogger(OBJECT_LOGGER)
+        objects.setLevel(settings['object_log_level'])
+        objects.addFilter(NoopSampler(settings['log_noop_sample']))
+        self.listener.start()
+        # Queued records are written before the program ends, even on quit()
+        atexit.register(self.close)
+
+    # Write the queued records and stop the writer thread
+    def close(self):
+        if self.listener is None:
+            return
+        logging.getLogger().removeHandler(self.handler)
+        self.listener.stop()
+        self.listener = None
+        self.file_handler.close()
 
 
 # retrieve Qumulo cluster ID
@@ -44,33 +362,80 @@ def get_cluster_id(rc, logging):
     return state['cluster_id']
 
 
-# check if IP belongs to the cluster
-def is_ip_on_cluster(cluster_id, secondary_cluster_address, secondary_port_number, secondary_username,
-                     secondary_password, logging):
-    # Try to connect to the IP address with secondary cluster credentials
+# Returns a session logged in on the target cluster of credentials (see load_targets), None if it can not be
+# reached
+def connect_target(credentials, logging, client=RestClient):
     try:
-        rc = RestClient(secondary_cluster_address, secondary_port_number)
-        rc.login(secondary_username, secondary_password)
-        logging.info('is_ip_on_cluster,  Connection established with {}'.format(secondary_cluster_address))
-        logging.info('is_ip_on_cluster,  {} is a Qumulo cluster'.format(secondary_cluster_address))
-        tgt_id = get_cluster_id(rc, logging)
-        if cluster_id == tgt_id:
-            logging.info('is_ip_on_cluster, IP address {} belongs to cluster {}'.
-                         format(secondary_cluster_address, tgt_id))
-            rc.close()
-            return True
-        else:
-            logging.info('is_ip_on_cluster, IP address {} do not belongs to cluster {}'.
-                         format(secondary_cluster_address, tgt_id))
-            rc.close()
-            return False
+        src = client(credentials['address'], credentials['port_number'])
+        src.login(credentials['username'], credentials['password'])
+        logging.info('connect_target,  Connection established with {}'.format(credentials['address']))
+        return src
+    except Exception as err:
+        logging.info('connect_target,  Connection cannot be established with {}'.format(credentials['address']))
+        logging.info(
+            'connect_target,  Error message is {}'.format(err.__dict__))
+        return None
+
+
+# Returns the id of the cluster answering on this address, None if it can not be reached with these credentials
+def get_address_cluster_id(address, port_number, username, password, logging, timeout=None):
+    try:
+        rc = RestClient(address, port_number, timeout=timeout)
+        rc.login(username, password)
+        logging.info('get_address_cluster_id,  Connection established with {}'.format(address))
+        logging.info('get_address_cluster_id,  {} is a Qumulo cluster'.format(address))
+        cluster_id = get_cluster_id(rc, logging)
+        rc.close()
+        return cluster_id
     except Exception as err:
-        logging.info('is_ip_on_cluster,  Connection cannot be established with {}'.format(secondary_cluster_address))
-        logging.info('is_ip_on_cluster,  Credentials for {} seems not correct or it is not a Qumulo cluster'
-                     .format(secondary_cluster_address))
+        logging.info('get_address_cluster_id,  Connection cannot be established with {}'.format(address))
+        logging.info('get_address_cluster_id,  Credentials for {} seems not correct or it is not a Qumulo cluster'
+                     .format(address))
         logging.info(
             'Error message is {}'.format(err.__dict__))
-        return False
+        return None
+
+
+# Returns a dict address -> cluster id (None if unreachable) for all addresses in argument
+# Distinct addresses are probed concurrently, addresses in known are not probed at all
+# Identified addresses are persisted in ./cache/addresses.json and reused for cache_ttl seconds
+def identify_addresses(addresses, port_number, username, password, logging, known=None, cache_ttl=0,
+                       timeout=None, workers=8):
+    cache_file = './cache/addresses.json'
+    now = datetime.now().timestamp()
+    cached = {}
+    if cache_ttl and os.path.exists(cache_file):
+        try:
+            with open(cache_file) as cache_json:
+                cached = json.load(cache_json)
+        except ValueError as err:
+            logging.info('identify_addresses, Cache file {} is not readable, ignoring it'.format(cache_file))
+    results = dict(known or {})
+    to_probe = []
+    for address in dict.fromkeys(addresses):
+        if address in results:
+            continue
+        entry = cached.get('{}:{}'.format(address, port_number))
+        if entry and entry[1] >= now - cache_ttl:
+            logging.info('identify_addresses, Address {} belongs to cluster {} (cached)'.format(address, entry[0]))
+            results[address] = entry[0]
+        else:
+            to_probe.append(address)
+    if to_probe:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(to_probe)))) as pool:
+            probed = pool.map(lambda address: get_address_cluster_id(address, port_number, username, password,
+                                                                     logging, timeout), to_probe)
+            for address, cluster_id in zip(to_probe, probed):
+                results[address] = cluster_id
+                # Only successful identifications are kept, unreachable addresses are probed again next run
+                if cluster_id is not None:
+                    cached['{}:{}'.format(address, port_number)] = [cluster_id, now]
+        if cache_ttl:
+            if not os.path.isdir('./cache'):
+                os.mkdir('./cache')
+            with open(cache_file, 'w') as cache_json:
+                json.dump(cached, cache_json, separators=(',', ':'))
+    return results
 
 
 # Returns the path related to the id
@@ -89,328 +454,2212 @@ def convert_path_to_id(rc, logging, path):
     return file_attr['id']
 
 
-# Get all SMB shares defined under the path in argument
-def get_smb_shr(prc, src, logging, path):
-    shares = []
-    # Retrieve all SMB Shares
+# Run func(rc, item) for every item over a bounded pool of sessions cloned from rc
+# Each worker thread gets its own session, results are returned in the same order as items
+def run_concurrently(rc, func, items, workers):
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [func(rc, item) for item in items]
+    sessions = []
+    local = threading.local()
+    caller_phase = in_caller_phase(rc)
+
+    def worker(item):
+        if not hasattr(local, 'rc'):
+            local.rc = rc.clone()
+            sessions.append(local.rc)
+        with caller_phase():
+            return func(local.rc, item)
+
     try:
-        all_shr = prc.smb.smb_list_shares()
-        # extract only shares defined under path
-        for shr in all_shr:
-            if path.rstrip(path[-1]) in shr['fs_path']:
-                logging.info(
-                    'get_smb_shr, Share {} will be replicated'.format(shr['share_name']))
-                # Check if there is an ACE referencing LOCAL trustee - if so, get its local name and translate
-                # for the secondary cluster if username exists on it - discard if it doesn't
-                final_perms = []
-                for perm in shr['permissions']:
-                    if perm['trustee']['domain'] == "LOCAL":
-
-                        # Get username from auth_id
-                        src_ident = prc.auth.find_identity(auth_id=perm['trustee']['auth_id'])
-
-                        # Check if username exists on secondary cluster and gets its auth_id and sid
-                        try:
-                            tgt_ident = src.auth.find_identity(domain='LOCAL',name=src_ident['name'])
-                            logging.info(
-                                'get_smb_shr, Username {} exists on secondary cluster, '
-                                'translating auth_id from {} to {} and sid from {} to {}'.
-                                    format(src_ident['name'], src_ident['auth_id'], tgt_ident['auth_id'],
-                                           src_ident['sid'], tgt_ident['sid']))
-                            perm['trustee']['auth_id'] = tgt_ident['auth_id']
-                            perm['trustee']['sid'] = tgt_ident['sid']
-                            final_perms.append(perm)
-                        except Exception as err:
-                            # If username do not exists on destination, remove the ACE
-                            logging.info(
-                                'get_smb_shr, Username {} do not exists on cluster {}'.
-                                    format(src_ident['name'], src.conninfo.host))
-                            logging.info(
-                                'get_smb_shr, Discarding ACE for user {} on share {}'.
-                                    format(src_ident['name'], shr['share_name']))
-                    else:
-                        final_perms.append(perm)
-                shr['permissions'] = final_perms
-                shares.append(shr)
-        shares = json.dumps(shares, indent=4)
-        return shares
+        with ThreadPoolExecutor(max_workers=min(workers, len(items))) as pool:
+            return list(pool.map(worker, items))
+    finally:
+        for session in sessions:
+            session.close()
+
+
+# Run independent reads concurrently, at most workers at a time, and returns their results in the order of reads
+# reads is a list of (rc, func), func(session) runs on a session cloned from rc ; the first error is raised once
+# every read is done
+def read_concurrently(reads, workers):
+    reads = list(reads)
+    if workers <= 1 or len(reads) <= 1:
+        return [func(rc) for rc, func in reads]
+    caller_phase = in_caller_phase(reads[0][0])
+
+    def read(rc_func):
+        rc, func = rc_func
+        session = rc.clone()
+        try:
+            with caller_phase():
+                return func(session)
+        finally:
+            session.close()
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(reads))) as pool:
+        return list(pool.map(read, reads))
+
+
+# Returns a context manager counting the calls of a worker thread in the phase of the calling thread, for
+# sessions recorded in metrics (see InstrumentedClient)
+def in_caller_phase(rc):
+    metrics = getattr(rc, 'metrics', None)
+    phase = metrics.current_phase() if metrics is not None else None
+    if phase is None:
+        return nullcontext
+    return lambda: metrics.phase(phase, timed=False)
+
+
+# Yields the items of iterable, the next one being produced by a background thread while the caller handles the
+# current one ; its calls are counted in the phase of the caller
+def prefetch(metrics, iterable):
+    phase = metrics.current_phase()
+    items = iter(iterable)
+
+    def next_item():
+        with metrics.phase(phase, timed=False) if phase is not None else nullcontext():
+            return next(items, StopIteration)
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        pending = pool.submit(next_item)
+        while True:
+            item = pending.result()
+            if item is StopIteration:
+                return
+            pending = pool.submit(next_item)
+            yield item
+
+
+# Upper bounds in seconds of the REST call latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+# Count, latency histogram, objects returned and errors of REST calls per cluster, phase and endpoint,
+# and time spent in each phase of a synchronization
+# Each thread has its own current phase, phases of target clusters synchronized concurrently are summed
+class RunMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.phases = {}
+        self.endpoints = {}
+
+    # Phase of the calling thread, None outside of any phase
+    def current_phase(self):
+        return getattr(self.local, 'name', None)
+
+    # Time the block as phase name, REST calls made meanwhile by this thread are counted in this phase
+    # Threads working for a phase timed by another thread join it with timed set to False
+    @contextmanager
+    def phase(self, name, timed=True):
+        previous = self.current_phase()
+        self.local.name = name
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            if timed:
+                with self.lock:
+                    self.phases[name] = self.phases.get(name, 0) + time.monotonic() - started
+            self.local.name = previous
+
+    # Record one REST call, items is the number of objects of the response, see response_items
+    def record(self, cluster, phase, endpoint, seconds, items=0, err=None):
+        with self.lock:
+            key = (cluster, phase, endpoint)
+            stats = self.endpoints.get(key)
+            if stats is None:
+                stats = self.endpoints[key] = {'count': 0, 'errors': {}, 'seconds': 0.0, 'items': 0,
+                                               'buckets': [0] * (len(LATENCY_BUCKETS) + 1)}
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['items'] += items
+            stats['buckets'][next((i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound),
+                                  len(LATENCY_BUCKETS))] += 1
+            if err is not None:
+                code = str(getattr(err, 'status_code', type(err).__name__))
+                stats['errors'][code] = stats['errors'].get(code, 0) + 1
+
+    # Returns the summary of a synchronization and starts counting the next one, objects are the counts of
+    # results returned by sync_cycle
+    def summary(self, run, seconds, objects):
+        with self.lock:
+            endpoints = [dict(stats, cluster=cluster, phase=phase, endpoint=endpoint)
+                         for (cluster, phase, endpoint), stats in sorted(self.endpoints.items())]
+            phases = {name: round(elapsed, 3) for name, elapsed in self.phases.items()}
+            self.phases = {}
+            self.endpoints = {}
+        return {'run': run, 'seconds': round(seconds, 3), 'finished': time.time(), 'phases': phases,
+                'objects': objects, 'latency_buckets': list(LATENCY_BUCKETS), 'endpoints': endpoints}
+
+
+# Number of objects of a REST response : entries of a list, of the largest list of a page (quotas of a page of
+# quotas for instance) or 1 for a single object, the response is not walked through
+def response_items(response):
+    if isinstance(response, list):
+        return len(response)
+    if isinstance(response, dict) and 'paging' in response:
+        return max((len(value) for value in response.values() if isinstance(value, list)), default=0)
+    return 0 if response is None else 1
+
+
+# Raised when a step a whole run depends on fails, the run is aborted but the program can go on
+class ReplicationError(Exception):
+    pass
+
+
+# Classify a REST error : not_found (404), transient (cluster busy or failing over, worth retrying),
+# unreachable (connection failure or timeout, the request may or may not have been applied) or fatal
+def classify_error(err):
+    status_code = getattr(err, 'status_code', None)
+    if status_code == 404:
+        return 'not_found'
+    if status_code in (429, 502, 503, 504):
+        return 'transient'
+    if status_code is None and isinstance(err, (OSError, http.client.HTTPException)):
+        return 'unreachable'
+    return 'fatal'
+
+
+# Bounds the number of concurrent REST calls and their rate on a cluster
+# The concurrency limit is halved each time the cluster reports it is overloaded and grows back by one after
+# as many successful calls as the current limit (additive increase, multiplicative decrease)
+class RequestGovernor:
+    def __init__(self, logging, cluster, max_concurrency=16, max_rate=0):
+        self.logging = logging
+        self.cluster = cluster
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = self.max_concurrency
+        self.interval = 1.0 / max_rate if max_rate else 0
+        self.condition = threading.Condition()
+        self.active = 0
+        self.successes = 0
+        self.next_start = 0.0
+
+    # Wait for a free slot, and for the rate limit, before running the block
+    @contextmanager
+    def slot(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+            now = time.monotonic()
+            delay = max(0.0, self.next_start - now)
+            self.next_start = max(now, self.next_start) + self.interval
+        try:
+            if delay:
+                time.sleep(delay)
+            yield
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.condition.notify()
+
+    def success(self):
+        with self.condition:
+            self.successes += 1
+            if self.limit < self.max_concurrency and self.successes >= self.limit:
+                self.limit += 1
+                self.successes = 0
+                self.condition.notify()
+
+    def overloaded(self):
+        with self.condition:
+            if self.limit > 1:
+                self.limit = max(1, self.limit // 2)
+                self.logging.info('RequestGovernor, Cluster {} is overloaded, up to {} concurrent calls now'.format(
+                    self.cluster, self.limit))
+            self.successes = 0
+
+
+# REST calls that may create an object twice if repeated after a lost response
+NON_IDEMPOTENT_CALLS = ('create_', 'add_')
+
+
+# How REST calls reach a cluster : governor, retry policy and a pool of idle sessions reused between parallel
+# stages so their connections are kept alive
+class Transport:
+    def __init__(self, rc, logging, metrics, settings):
+        self.logging = logging
+        self.metrics = metrics
+        self.cluster = rc.conninfo.host
+        self.retries = settings['retries']
+        self.retry_base_delay = settings['retry_base_delay']
+        self.retry_max_delay = settings['retry_max_delay']
+        self.governor = RequestGovernor(logging, self.cluster, settings['max_concurrency'], settings['max_rate'])
+        self.lock = threading.Lock()
+        self.idle = []
+        self.random = random.Random()
+
+    # Returns a session logged in as rc, an idle one if any
+    def acquire(self, rc):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return rc.clone()
+
+    # Give back a session, sessions beyond max_concurrency are closed
+    def release(self, session):
+        with self.lock:
+            if len(self.idle) < self.governor.max_concurrency:
+                self.idle.append(session)
+                return
+        session.close()
+
+    # Close idle sessions, they are cloned again with the current credentials when needed
+    def reset(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for session in idle:
+            session.close()
+
+    # Run request(), a single REST call, within the governor and retry it on transient errors with an
+    # exponential backoff with full jitter, connection failures are only retried for calls safe to repeat
+    def call(self, endpoint, phase, request):
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                with self.governor.slot():
+                    response = request()
+            except StopIteration:
+                raise
+            except Exception as err:
+                self.metrics.record(self.cluster, phase(), endpoint, time.monotonic() - started, err=err)
+                kind = classify_error(err)
+                if kind == 'transient':
+                    self.governor.overloaded()
+                retry = kind == 'transient' or (kind == 'unreachable' and not any(
+                    name in endpoint for name in NON_IDEMPOTENT_CALLS))
+                if not retry or attempt >= self.retries:
+                    raise
+                delay = self.random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** attempt))
+                self.logging.info('Transport, {} on {} failed ({}), retrying in {:.2f}s'.format(
+                    endpoint, self.cluster, kind, delay))
+                attempt += 1
+                time.sleep(delay)
+                continue
+            self.governor.success()
+            self.metrics.record(self.cluster, phase(), endpoint, time.monotonic() - started,
+                                response_items(response))
+            return response
+
+
+# Wraps a function of a REST client module, its calls go through the transport of client
+# Paged results are consumed lazily, each page is a call of its own
+def instrument(func, client, endpoint):
+    def phase():
+        return client.metrics.current_phase() or client.phase
+
+    def paged(pages):
+        while True:
+            try:
+                page = client.transport.call(endpoint, phase, lambda: next(pages))
+            except StopIteration:
+                return
+            yield page
+
+    def call(*args, **kwargs):
+        response = client.transport.call(endpoint, phase, lambda: func(*args, **kwargs))
+        if hasattr(response, '__next__') or type(response).__name__.endswith('PagingIterator'):
+            return paged(iter(response))
+        return response
+    return call
+
+
+# REST client module whose calls go through the transport of client
+class InstrumentedModule:
+    def __init__(self, module, client, name):
+        self.module = module
+        self.client = client
+        self.name = name
+
+    def __getattr__(self, name):
+        attr = getattr(self.module, name)
+        if callable(attr):
+            return instrument(attr, self.client, '{}.{}'.format(self.name, name))
+        return attr
+
+
+# RestClient whose calls go through a Transport (governor, retries) and are recorded in metrics
+# Sessions cloned from it share the same transport and are taken from, and given back on close to, its pool
+# Calls are counted in the phase of the calling thread, or in the phase the session was cloned in for worker
+# threads which are outside of any phase
+class InstrumentedClient:
+    def __init__(self, rc, metrics, transport, phase='discovery', pooled=False):
+        self.rc = rc
+        self.metrics = metrics
+        self.transport = transport
+        self.phase = phase
+        self.pooled = pooled
+        self.cluster = rc.conninfo.host
+
+    def clone(self):
+        return InstrumentedClient(self.transport.acquire(self.rc), self.metrics, self.transport,
+                                  self.metrics.current_phase() or self.phase, pooled=True)
+
+    def close(self):
+        if self.pooled:
+            self.transport.release(self.rc)
+        else:
+            self.transport.reset()
+            self.rc.close()
+
+    # Raw REST call, recorded as endpoint, the name of the module function it stands for
+    def request(self, method, uri, endpoint='request'):
+        return instrument(self.rc.request, self, endpoint)(method, uri)
+
+    def __getattr__(self, name):
+        attr = getattr(self.rc, name)
+        if name in ('conninfo', 'Error') or isinstance(attr, (str, int, float, bool, type(None))):
+            return attr
+        if callable(attr):
+            return instrument(attr, self, name)
+        return InstrumentedModule(attr, self, name)
+
+
+# Prometheus label set
+def metric_labels(**labels):
+    return ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for name, value in labels.items())
+
+
+# Returns the summary of a synchronization in the Prometheus text format, values are the ones of the last run
+def prometheus_text(summary):
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append('# HELP q_replicate_config_{} {}'.format(name, help_text))
+        lines.append('# TYPE q_replicate_config_{} {}'.format(name, kind))
+        for suffix, labels, value in samples:
+            lines.append('q_replicate_config_{}{}{{{}}} {}'.format(name, suffix, labels, value))
+
+    metric('last_run_timestamp_seconds', 'gauge', 'End of the last synchronization',
+           [('', '', summary['finished'])])
+    metric('run_duration_seconds', 'gauge', 'Duration of the last synchronization',
+           [('', '', summary['seconds'])])
+    metric('phase_duration_seconds', 'gauge', 'Time spent in each phase of the last synchronization',
+           [('', metric_labels(phase=phase), seconds) for phase, seconds in sorted(summary['phases'].items())])
+    metric('objects', 'gauge', 'Objects processed by the last synchronization',
+           [('', metric_labels(type=name.split('|')[0], action=name.split('|')[1], status=name.split('|')[2]), count)
+            for name, count in sorted(summary['objects'].items())])
+    metric('rest_requests', 'gauge', 'REST calls made by the last synchronization',
+           [('', metric_labels(cluster=ep['cluster'], phase=ep['phase'], endpoint=ep['endpoint']), ep['count'])
+            for ep in summary['endpoints']])
+    metric('rest_errors', 'gauge', 'Failed REST calls made by the last synchronization',
+           [('', metric_labels(cluster=ep['cluster'], phase=ep['phase'], endpoint=ep['endpoint'], code=code), count)
+            for ep in summary['endpoints'] for code, count in sorted(ep['errors'].items())])
+    metric('rest_response_items', 'gauge', 'Objects returned by REST calls of the last synchronization',
+           [('', metric_labels(cluster=ep['cluster'], phase=ep['phase'], endpoint=ep['endpoint']), ep['items'])
+            for ep in summary['endpoints']])
+    samples = []
+    for ep in summary['endpoints']:
+        cumulated = 0
+        for bound, count in zip(summary['latency_buckets'] + ['+Inf'], ep['buckets']):
+            cumulated += count
+            samples.append(('_bucket', metric_labels(cluster=ep['cluster'], phase=ep['phase'], endpoint=ep['endpoint'],
+                                                     le=bound), cumulated))
+        labels = metric_labels(cluster=ep['cluster'], phase=ep['phase'], endpoint=ep['endpoint'])
+        samples.append(('_sum', labels, round(ep['seconds'], 6)))
+        samples.append(('_count', labels, ep['count']))
+    metric('rest_request_duration_seconds', 'histogram', 'Latency of REST calls made by the last synchronization',
+           samples)
+    return '\n'.join(lines) + '\n'
+
+
+# Write a file through a temporary file so readers never see it half written
+def write_atomically(path, content):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+# Log the summary of a synchronization and write it as JSON to metrics_file and in the Prometheus text format
+# to prometheus_file, an empty file name disables the output
+def write_metrics(logging, summary, metrics_file, prometheus_file):
+    calls = sum(ep['count'] for ep in summary['endpoints'])
+    errors = sum(sum(ep['errors'].values()) for ep in summary['endpoints'])
+    logging.info('write_metrics, Run {} took {}s, {} REST calls, {} failed, phases {}'.format(
+        summary['run'], summary['seconds'], calls, errors,
+        ', '.join('{} {}s'.format(phase, seconds) for phase, seconds in summary['phases'].items())))
+    try:
+        if metrics_file:
+            write_atomically(metrics_file, json.dumps(summary, indent=2))
+        if prometheus_file:
+            write_atomically(prometheus_file, prometheus_text(summary))
+    except OSError as err:
+        logging.error('write_metrics, Cannot write run metrics')
+        logging.error('write_metrics, Error message is {}'.format(err))
+
+
+# Resolve ids to paths and paths to ids on a cluster
+# Results are kept for the whole run and, if cache_ttl is set, persisted in ./cache/paths-<cluster_id>.json
+# Qumulo never reuses a file id, so an entry can only become stale if the directory is moved or recreated :
+# entries expire after cache_ttl seconds and are dropped as soon as a fresh lookup disagrees with them
+class PathResolver:
+    def __init__(self, rc, logging, cluster_id, cache_ttl=0, workers=8, batch_size=1000):
+        self.rc = rc
+        self.logging = logging
+        self.cache_ttl = cache_ttl
+        self.workers = workers
+        self.batch_size = batch_size
+        self.cache_file = './cache/paths-{}.json'.format(cluster_id)
+        self.lock = threading.Lock()
+        # id -> [path, time of resolution] and path -> id
+        self.id_to_path = {}
+        self.path_to_id = {}
+        if self.cache_ttl:
+            self.load()
+
+    # Load entries still valid from the on-disk cache
+    def load(self):
+        if not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file) as cache_json:
+                entries = json.load(cache_json)
+        except ValueError as err:
+            self.logging.info('PathResolver, Cache file {} is not readable, ignoring it'.format(self.cache_file))
+            return
+        oldest = datetime.now().timestamp() - self.cache_ttl
+        for file_id, (path, resolved) in entries.items():
+            if resolved >= oldest:
+                self.id_to_path[file_id] = [path, resolved]
+                self.path_to_id[path] = file_id
+        self.logging.info('PathResolver, {} entries loaded from {}'.format(len(self.id_to_path), self.cache_file))
+
+    # Write the resolved entries to the on-disk cache
+    def save(self):
+        if not self.cache_ttl:
+            return
+        if not os.path.isdir('./cache'):
+            os.mkdir('./cache')
+        with self.lock:
+            entries = dict(self.id_to_path)
+        tmp_file = self.cache_file + '.tmp'
+        with open(tmp_file, 'w') as cache_json:
+            json.dump(entries, cache_json, separators=(',', ':'))
+        os.replace(tmp_file, self.cache_file)
+        self.logging.info('PathResolver, {} entries saved to {}'.format(len(entries), self.cache_file))
+
+    # Record a resolution and drop entries it contradicts
+    def remember(self, file_id, path):
+        with self.lock:
+            old_path = self.id_to_path.get(file_id, [None])[0]
+            if old_path is not None and old_path != path:
+                self.path_to_id.pop(old_path, None)
+            old_id = self.path_to_id.get(path)
+            if old_id is not None and old_id != file_id:
+                self.id_to_path.pop(old_id, None)
+            self.id_to_path[file_id] = [path, datetime.now().timestamp()]
+            self.path_to_id[path] = file_id
+
+    # Drop an entry, e.g. when the target cluster rejects an id
+    def forget(self, file_id=None, path=None):
+        with self.lock:
+            if path is not None:
+                file_id = self.path_to_id.pop(path, file_id)
+            if file_id is not None:
+                self.id_to_path.pop(file_id, None)
+
+    def _resolve_batch(self, rc, ids):
+        return [(entry['id'], entry['path']) for entry in rc.fs.resolve_paths(ids)]
+
+    def _resolve_one(self, rc, file_id):
+        return file_id, convert_id_to_path(rc, self.logging, file_id)
+
+    # Returns a dict id -> path, unknown ids are resolved in batches over parallel sessions
+    # rc is the session to resolve from when called from a worker thread, default is the resolver one
+    def paths(self, ids, rc=None):
+        rc = rc or self.rc
+        found = {}
+        missing = []
+        for file_id in dict.fromkeys(ids):
+            entry = self.id_to_path.get(file_id)
+            if entry is None:
+                missing.append(file_id)
+            else:
+                found[file_id] = entry[0]
+        if missing:
+            self.logging.info(
+                'PathResolver, Resolving {} ids on cluster {}'.format(len(missing), rc.conninfo.host))
+            batches = [missing[i:i + self.batch_size] for i in range(0, len(missing), self.batch_size)]
+            try:
+                resolved = [entry for batch in run_concurrently(rc, self._resolve_batch, batches, self.workers)
+                            for entry in batch]
+            except Exception as err:
+                # Clusters without the bulk endpoint : fall back to one request per id
+                # A busy or unreachable cluster would not do better one id at a time
+                if classify_error(err) in ('transient', 'unreachable'):
+                    raise
+                self.logging.info(
+                    'PathResolver, Bulk resolution not available on cluster {}, resolving ids one by one'.
+                    format(rc.conninfo.host))
+                resolved = run_concurrently(rc, self._resolve_one, missing, self.workers)
+            for file_id, path in resolved:
+                self.remember(file_id, path)
+                found[file_id] = path
+        return found
+
+    # Returns the id related to the path
+    def id(self, path, rc=None):
+        file_id = self.path_to_id.get(path)
+        if file_id is None:
+            file_id = convert_path_to_id(rc or self.rc, self.logging, path)
+            self.remember(file_id, path)
+        return file_id
+
+
+# Translate LOCAL trustees of the primary cluster to the same user or group on the secondary cluster
+# Translations are keyed by source auth_id and kept for the whole run, including users missing on the
+# secondary cluster. Local users and groups of both clusters are listed once on first use so most
+# translations cost no request at all, find_identity is only used for trustees missing from those lists
+# Lists and lookups are made concurrently over up to workers sessions of each cluster
+class IdentityMap:
+    def __init__(self, prc, src, logging, workers=1):
+        self.prc = prc
+        self.src = src
+        self.logging = logging
+        self.workers = workers
+        self.lock = threading.Lock()
+        # source auth_id -> source identity, target name -> target identity, source auth_id -> translated trustee
+        self.src_identities = {}
+        self.tgt_identities = {}
+        self.translations = {}
+        # None until local identities have been listed, then True if they could be listed
+        self.prefilled = None
+
+    # List local users and groups of both clusters
+    def prefill(self):
+        try:
+            readers = (lambda session: session.users.list_users(), lambda session: session.groups.list_groups())
+            lists = read_concurrently([(rc, reader) for rc in (self.prc, self.src) for reader in readers],
+                                      self.workers)
+            for idents, identities, key in ((lists[0] + lists[1], self.src_identities, 'auth_id'),
+                                            (lists[2] + lists[3], self.tgt_identities, 'name')):
+                for ident in idents:
+                    ident = {'auth_id': str(ident['id']), 'name': ident['name'], 'sid': ident['sid']}
+                    identities[ident[key]] = ident
+            self.prefilled = True
+            self.logging.info(
+                'IdentityMap, {} local identities on {} and {} on {}'.format(
+                    len(self.src_identities), self.prc.conninfo.host, len(self.tgt_identities), self.src.conninfo.host))
+        except Exception as err:
+            self.prefilled = False
+            self.logging.info('IdentityMap, Can not list local identities, they will be looked up one by one')
+            self.logging.info('IdentityMap, Error message is {}'.format(err.__dict__))
+
+    # List local users and groups of both clusters unless they already were
+    def ensure_prefilled(self):
+        with self.lock:
+            if self.prefilled is None:
+                self.prefill()
+
+    # Returns the LOCAL identity named name on the secondary cluster, None if it does not exist there
+    def find_target_identity(self, rc, name):
+        try:
+            return rc.auth.find_identity(domain='LOCAL', name=name)
+        except Exception as err:
+            # Only a missing identity is remembered as missing, other errors abort the translation
+            if classify_error(err) != 'not_found':
+                raise
+            return None
+
+    # Look up concurrently the identities of the LOCAL trustees auth_ids that are not in the lists of local
+    # identities, so translating them does not wait for one request after the other
+    def resolve(self, auth_ids):
+        self.ensure_prefilled()
+        with self.lock:
+            auth_ids = [auth_id for auth_id in dict.fromkeys(auth_ids) if auth_id not in self.translations]
+            missing = [auth_id for auth_id in auth_ids if auth_id not in self.src_identities]
+        if missing:
+            found = run_concurrently(self.prc, lambda rc, auth_id: rc.auth.find_identity(auth_id=auth_id), missing,
+                                     self.workers)
+            with self.lock:
+                self.src_identities.update(zip(missing, found))
+        if not self.prefilled:
+            with self.lock:
+                names = [name for name in dict.fromkeys(self.src_identities[auth_id]['name'] for auth_id in auth_ids)
+                         if name not in self.tgt_identities]
+            found = run_concurrently(self.src, self.find_target_identity, names, self.workers)
+            with self.lock:
+                self.tgt_identities.update(zip(names, found))
+
+    # Returns the trustee translated for the secondary cluster, None if the identity does not exist there
+    def translate(self, trustee):
+        auth_id = trustee['auth_id']
+        with self.lock:
+            if self.prefilled is None:
+                self.prefill()
+            if auth_id in self.translations:
+                translated = self.translations[auth_id]
+                return None if translated is None else dict(trustee, **translated)
+            # Get username from auth_id
+            src_ident = self.src_identities.get(auth_id)
+            if src_ident is None:
+                src_ident = self.prc.auth.find_identity(auth_id=auth_id)
+            # Check if username exists on secondary cluster and gets its auth_id and sid
+            if src_ident['name'] in self.tgt_identities:
+                tgt_ident = self.tgt_identities[src_ident['name']]
+            elif not self.prefilled:
+                tgt_ident = self.find_target_identity(self.src, src_ident['name'])
+            else:
+                tgt_ident = None
+            if tgt_ident is None:
+                self.logging.info(
+                    'IdentityMap, Username {} do not exists on cluster {}'.format(src_ident['name'], self.src.conninfo.host))
+                self.translations[auth_id] = None
+                return None
+            self.logging.info(
+                'IdentityMap, Username {} exists on secondary cluster, '
+                'translating auth_id from {} to {} and sid from {} to {}'.
+                format(src_ident['name'], src_ident['auth_id'], tgt_ident['auth_id'], src_ident['sid'],
+                       tgt_ident['sid']))
+            self.translations[auth_id] = {'auth_id': tgt_ident['auth_id'], 'sid': tgt_ident['sid']}
+            return dict(trustee, **self.translations[auth_id])
+
+    # Returns the ACEs translated for the secondary cluster, ACEs of LOCAL trustees missing there are discarded
+    # Usable for any object carrying an ACL made of entries with a trustee
+    def translate_permissions(self, permissions, object_name):
+        final_perms = []
+        for perm in permissions:
+            if perm['trustee']['domain'] != "LOCAL":
+                final_perms.append(perm)
+                continue
+            trustee = self.translate(perm['trustee'])
+            if trustee is None:
+                object_logger(self.logging).info('IdentityMap, Discarding ACE for auth_id %s on %s',
+                                                 perm['trustee']['auth_id'], object_name)
+            else:
+                final_perms.append(dict(perm, trustee=trustee))
+        return final_perms
+
+
+# Split a path in its components, ignoring leading, trailing and duplicated /
+def split_path(path):
+    return [part for part in path.split('/') if part]
+
+
+# Build a path component trie from the replicated source roots
+# Each node is a dict of child components, the None key marks a replicated root and holds (source root, target root)
+# Roots in excluded hold None so paths under them are left out instead of going to an enclosing root
+def build_path_trie(path_translation, excluded=()):
+    path_trie = {}
+    for src_root, dst_root in path_translation.items():
+        node = path_trie
+        for part in split_path(src_root):
+            node = node.setdefault(part, {})
+        node[None] = None if src_root in excluded else (src_root, dst_root)
+    return path_trie
+
+
+# Returns the replicated roots of path_translation matching one of the glob patterns, all of them without pattern
+# Trailing / of roots and patterns are ignored, /projects/* matches the roots under /projects but not /projects
+def select_roots(path_translation, patterns):
+    if not patterns:
+        return dict(path_translation)
+    patterns = [pattern.rstrip('/') or '/' for pattern in patterns]
+    return {src_root: dst_root for src_root, dst_root in path_translation.items()
+            if any(fnmatch.fnmatchcase(src_root.rstrip('/') or '/', pattern) for pattern in patterns)}
+
+
+# Returns the longest replicated root containing path and the path translated under its target root
+# Returns (None, None) if path is not under any replicated root - trailing / of path is kept as is
+def translate_path(path_trie, path):
+    parts = split_path(path)
+    node = path_trie
+    match = node.get(None)
+    depth = 0
+    for i, part in enumerate(parts):
+        node = node.get(part)
+        if node is None:
+            break
+        if None in node:
+            match = node[None]
+            depth = i + 1
+    if match is None:
+        return None, None
+    src_root, dst_root = match
+    dst_parts = split_path(dst_root) + parts[depth:]
+    dst_path = '/' + '/'.join(dst_parts)
+    if dst_parts and path.endswith('/'):
+        dst_path += '/'
+    return src_root, dst_path
+
+
+# Split the inventory per replicated root, each object goes to its longest matching root
+# Objects outside of any replicated root are left out
+def scope_inventory(inventory, path_trie, roots):
+    scoped = {root: {kind: {} for kind in inventory} for root in roots}
+    for kind, index in inventory.items():
+        for fs_path, objects in index.items():
+            src_root, dst_path = translate_path(path_trie, fs_path)
+            if src_root is not None:
+                scoped[src_root][kind][fs_path] = objects
+    return scoped
+
+
+# Yields the quotas of the cluster page by page as (cursor, [(path, quota)...]), page_size quotas at a time
+# cursor is the URI of the next page, None after the last page, after resumes the enumeration from a cursor
+# Directory ids of each page are resolved to paths at once, rc is an InstrumentedClient so pages are recorded as
+# quota.get_all_quotas calls
+def get_quota_pages(rc, logging, resolver, page_size=1000, after=None):
+    uri = after or '/v1/files/quotas/?limit={}'.format(page_size)
+    while uri:
+        try:
+            page = rc.request('GET', uri, endpoint='quota.get_all_quotas')
+            quota_paths = resolver.paths([quota['id'] for quota in page['quotas']])
+        except Exception as err:
+            logging.error(
+                'get_quota_pages, There was an issue : Can not retrieve quotas from {}'.
+                format(rc.conninfo.host))
+            logging.error(
+                'get_quota_pages, Error message is {}'.format(err.__dict__))
+            raise ReplicationError('Can not retrieve quotas from {}'.format(rc.conninfo.host)) from err
+        uri = page['paging']['next']
+        yield uri, [(quota_paths[quota['id']], quota) for quota in page['quotas']]
+
+
+# Retrieve all SMB shares of a cluster, indexed by filesystem path
+def get_smb_inventory(rc, logging):
+    shares = {}
+    try:
+        for shr in rc.smb.smb_list_shares():
+            shares.setdefault(shr['fs_path'], []).append(shr)
+        logging.info(
+            'get_inventory, {} SMB shares retrieved from {}'.format(
+                sum(len(shrs) for shrs in shares.values()), rc.conninfo.host))
     except Exception as err:
         logging.error(
-            'get_smb_shr, There was an issue : Can not retrieve SMB Shares from {}'.
-            format(prc.conninfo.host))
+            'get_inventory, There was an issue : Can not retrieve SMB Shares from {}'.
+            format(rc.conninfo.host))
         logging.error(
-            'get_smb_shr, Error message is {}'.format(err.__dict__))
-        logging.info('get_smb_shr, Ending program now')
-        quit()
+            'get_inventory, Error message is {}'.format(err.__dict__))
+        raise ReplicationError('Can not retrieve SMB Shares from {}'.format(rc.conninfo.host)) from err
+    return shares
 
 
-# Get all NFS exports defined under the path in argument
-def get_nfs_exp(rc, logging, path):
-    exports = []
-    # Retrieve all NFS Exports
+# Retrieve all NFS exports of a cluster, indexed by filesystem path
+def get_nfs_inventory(rc, logging):
+    exports = {}
     try:
-        all_exp = rc.nfs.nfs_list_exports()
-        # extract only exports defined under path
-        for exp in all_exp:
-            if path.rstrip(path[-1]) in exp['fs_path']:
-                exports.append(exp)
-                logging.info(
-                    'get_nfs_exp, Export {} will be replicated'.format(exp['export_path']))
-        exports = json.dumps(exports, indent=4)
-        return exports
+        for exp in rc.nfs.nfs_list_exports():
+            exports.setdefault(exp['fs_path'], []).append(exp)
+        logging.info(
+            'get_inventory, {} NFS exports retrieved from {}'.format(
+                sum(len(exps) for exps in exports.values()), rc.conninfo.host))
     except Exception as err:
         logging.error(
-            'get_nfs_exp, There was an issue : Can not retrieve NFS exports from {}'.
+            'get_inventory, There was an issue : Can not retrieve NFS exports from {}'.
             format(rc.conninfo.host))
         logging.error(
-            'get_nfs_exp, Error message is {}'.format(err.__dict__))
-        logging.info('get_nfs_exp, Ending program now')
-        quit()
+            'get_inventory, Error message is {}'.format(err.__dict__))
+        raise ReplicationError('Can not retrieve NFS exports from {}'.format(rc.conninfo.host)) from err
+    return exports
 
 
-# Get all quotas defined under the path in argument
-def get_quotas(rc, logging, path):
-    quotas = []
-    # Retrieve all quotas
+# Retrieve all quotas of a cluster, indexed by directory path
+# Quotas are identified by directory id, so all paths of a page are resolved at once
+def get_quota_inventory(rc, logging, resolver, page_size=1000):
+    quotas = {}
+    for cursor, page in get_quota_pages(rc, logging, resolver, page_size):
+        for quota_path, quota in page:
+            quotas.setdefault(quota_path, []).append(quota)
+    logging.info(
+        'get_inventory, {} quotas retrieved from {}'.format(
+            sum(len(all_quotas) for all_quotas in quotas.values()), rc.conninfo.host))
+    return quotas
+
+
+# Retrieve the SMB shares, NFS exports and quotas of a cluster once per run, only for object types in types
+# Each inventory is indexed by filesystem path so every replicated path only picks its own subset
+# Object types are retrieved concurrently over up to workers sessions cloned from rc
+def get_inventory(rc, logging, resolver, types=OBJECT_TYPES, page_size=1000, workers=1):
+    readers = {'smb': lambda session: get_smb_inventory(session, logging),
+               'nfs': lambda session: get_nfs_inventory(session, logging),
+               'quotas': lambda session: get_quota_inventory(session, logging, resolver, page_size)}
+    kinds = [kind for kind in ('smb', 'nfs', 'quotas') if kind in types]
+    inventory = {'smb': {}, 'nfs': {}, 'quotas': {}}
+    inventory.update(zip(kinds, read_concurrently([(rc, readers[kind]) for kind in kinds], workers)))
+    return inventory
+
+
+# Yields the SMB shares defined under the path in argument, inventory is the one scoped to this path
+# Permissions referencing LOCAL trustees are translated for the secondary cluster with identities
+def get_smb_shr(prc, src, logging, path, inventory, identities):
+    log = object_logger(logging)
+    detailed = log.isEnabledFor(logging.DEBUG)
     try:
-        all_quotas = rc.quota.get_all_quotas()
-        # API sends a list with quotas and paging, we don't use paging item
-        for elements in all_quotas:
-            # Just get info from quotas, not paging
-            if elements['quotas']:
-                for quota in elements['quotas']:
-                    # Get path from id
-                    quota_path = convert_id_to_path(rc, logging, quota['id'])
-                    if path.rstrip(path[-1]) in quota_path:
-                        quotas.append(quota)
-                        logging.info(
-                            'get_quotas, Quota for directory {} will be replicated'.format(path))
-        quotas = json.dumps(quotas, indent=4)
-        return quotas
+        # LOCAL trustees missing from the local identities lists are looked up at once
+        identities.resolve([ace['trustee']['auth_id'] for all_shr in inventory['smb'].values() for shr in all_shr
+                            for ace in shr['permissions'] if ace['trustee']['domain'] == 'LOCAL'])
+        for fs_path, all_shr in inventory['smb'].items():
+            for shr in all_shr:
+                if detailed:
+                    log.debug('get_smb_shr, Share %s will be replicated', shr['share_name'],
+                              extra={'type': 'smb', 'root': path, 'key': shr['share_name']})
+                # Check if there is an ACE referencing LOCAL trustee - if so, get its local name and translate
+                # for the secondary cluster if username exists on it - discard if it doesn't
+                # Permissions are copied as the inventory is shared by all replicated paths
+                final_perms = identities.translate_permissions(shr['permissions'],
+                                                               'share {}'.format(shr['share_name']))
+                yield ConfigRecord('smb', path, shr['share_name'], fs_path, dict(shr, permissions=final_perms))
     except Exception as err:
         logging.error(
-            'get_quotas, There was an issue : Can not retrieve quotas from {}'.
-            format(rc.conninfo.host))
+            'get_smb_shr, There was an issue : Can not translate SMB Shares from {}'.
+            format(prc.conninfo.host))
         logging.error(
-            'get_quotas, Error message is {}'.format(err.__dict__))
-        logging.info('get_quotas, Ending program now')
-        quit()
+            'get_smb_shr, Error message is {}'.format(err.__dict__))
+        raise ReplicationError('Can not translate SMB Shares from {}'.format(prc.conninfo.host)) from err
+
+
+# Yields the NFS exports defined under the path in argument, inventory is the one scoped to this path
+def get_nfs_exp(rc, logging, path, inventory):
+    log = object_logger(logging)
+    detailed = log.isEnabledFor(logging.DEBUG)
+    for fs_path, all_exp in inventory['nfs'].items():
+        for exp in all_exp:
+            if detailed:
+                log.debug('get_nfs_exp, Export %s will be replicated', exp['export_path'],
+                          extra={'type': 'nfs', 'root': path, 'key': exp['export_path']})
+            yield ConfigRecord('nfs', path, exp['export_path'], fs_path, exp)
+
+
+# Yields the records of a page of quotas (see get_quota_pages) defined under a replicated path of path_trie
+def get_quotas(logging, path_trie, quotas):
+    log = object_logger(logging)
+    detailed = log.isEnabledFor(logging.DEBUG)
+    for quota_path, quota in quotas:
+        src_root, dst_path = translate_path(path_trie, quota_path)
+        if src_root is not None:
+            if detailed:
+                log.debug('get_quotas, Quota for directory %s will be replicated', quota_path,
+                          extra={'type': 'quotas', 'root': src_root, 'key': quota_path})
+            yield ConfigRecord('quotas', src_root, quota_path, quota_path, quota)
+
+
+# Fields compared between source and target objects, other fields (ids...) are specific to each cluster
+NFS_FIELDS = ('export_path', 'fs_path', 'description', 'restrictions', 'fields_to_present_as_32_bit')
+SMB_FIELDS = ('share_name', 'fs_path', 'description', 'access_based_enumeration_enabled', 'default_file_create_mode',
+              'default_directory_create_mode', 'permissions', 'require_encryption', 'network_permissions')
+
+
+# Retrieve SMB shares, NFS exports and quotas (object types in types) of the target cluster once
+# Objects are indexed by share name, export path and quota path, and split per target root for deletions
+def get_target_snapshot(rc, logging, resolver, path_translation, page_size=1000, types=OBJECT_TYPES, workers=1):
+    inventory = get_inventory(rc, logging, resolver, types, page_size, workers)
+    dst_roots = list(dict.fromkeys(path_translation.values()))
+    dst_trie = build_path_trie({dst: dst for dst in dst_roots})
+    snapshot = {'smb': {}, 'nfs': {}, 'quotas': {}, 'trie': dst_trie,
+                'roots': scope_inventory(inventory, dst_trie, dst_roots)}
+    for all_shr in inventory['smb'].values():
+        for shr in all_shr:
+            snapshot['smb'][shr['share_name']] = shr
+    for all_exp in inventory['nfs'].values():
+        for exp in all_exp:
+            snapshot['nfs'][exp['export_path']] = exp
+    for quota_path, all_quotas in inventory['quotas'].items():
+        for quota in all_quotas:
+            snapshot['quotas'][quota_path] = quota
+    return snapshot
+
+
+# Trustees are compared on their sid when they have one, auth_id are only meaningful on their own cluster
+def normalize_trustee(trustee):
+    if trustee.get('sid'):
+        return {'domain': trustee.get('domain'), 'sid': trustee['sid']}
+    return {'domain': trustee.get('domain'), 'auth_id': trustee.get('auth_id')}
+
+
+# Returns a canonical form of the fields of an object, used to compare source and target objects
+def normalize_object(obj, fields):
+    normalized = {}
+    for field in fields:
+        value = obj.get(field)
+        if field == 'permissions' and value:
+            value = [dict(ace, trustee=normalize_trustee(ace['trustee']), rights=sorted(ace.get('rights', [])))
+                     for ace in value]
+        normalized[field] = value
+    return json.dumps(normalized, sort_keys=True)
+
+
+# Returns the hash of a source record, used to recognize objects already applied on the target
+def record_digest(record):
+    return hashlib.sha256(json.dumps(record.data, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+# Returns the fingerprint of the source objects of a type under a replicated path, objects is the inventory of
+# this type scoped to the path and dst_root the target root they are translated to
+# Only replicated fields are taken in account, in canonical form, so it does not change between runs
+def config_fingerprint(object_type, objects, dst_root, mirror_deletes):
+    fields = NFS_FIELDS if object_type == 'nfs' else SMB_FIELDS
+    canonical = sorted(normalize_object(obj, fields) for all_objects in objects.values() for obj in all_objects)
+    return hashlib.sha256(json.dumps([object_type, dst_root, mirror_deletes, canonical]).encode()).hexdigest()
+
+
+# Build a plan entry, action is create, update, noop or delete
+# source is the object as it should be on the target, target is the object currently on the target
+# digest is the hash of the source record the entry comes from
+def plan_entry(object_type, action, key, root, source, target, digest=None):
+    return {'type': object_type, 'action': action, 'key': key, 'root': root, 'source': source, 'target': target,
+            'digest': digest}
+
+
+# Returns True if the record was already applied as is on the target, applied is a dict
+# (object_type, root, key) -> record digest kept between synchronizations
+def already_applied(applied, record, digest):
+    return applied is not None and applied.get((record.object_type, record.root, record.key)) == digest
+
+
+# Returns the keys of the objects of a type of an inventory, export paths or share names
+def source_keys(inventory, object_type):
+    key_field = 'export_path' if object_type == 'nfs' else 'share_name'
+    return {obj[key_field] for objects in inventory.get(object_type, {}).values() for obj in objects}
+
+
+# Objects of the target root that are not in the source any more
+def plan_deletions(object_type, root, path_trie, snapshot, kept_keys, key_field):
+    entries = []
+    src_root, dst_root = translate_path(path_trie, root)
+    for fs_path, objects in snapshot['roots'].get(dst_root, {}).get(object_type, {}).items():
+        for obj in objects:
+            key = fs_path if key_field is None else obj[key_field]
+            if key not in kept_keys:
+                entries.append(plan_entry(object_type, 'delete', key, root, None, obj))
+    return entries
+
+
+# Compare source quota records of a replicated root with the target snapshot
+def plan_quotas(logging, records, root, path_trie, snapshot, mirror_deletes=False, applied=None):
+    plan = []
+    for record in records:
+        digest = record_digest(record)
+        src_root, dst_path = translate_path(path_trie, record.path)
+        source = {'path': dst_path, 'source_path': record.path, 'limit': str(record.data['limit'])}
+        target = snapshot['quotas'].get(dst_path)
+        if already_applied(applied, record, digest) and target is not None:
+            action = 'noop'
+        elif target is None:
+            action = 'create'
+        elif str(target['limit']) != source['limit']:
+            action = 'update'
+        else:
+            action = 'noop'
+        plan.append(plan_entry('quotas', action, dst_path, root, source, target, digest))
+    if mirror_deletes:
+        plan.extend(plan_deletions('quotas', root, path_trie, snapshot, {entry['key'] for entry in plan}, None))
+    return plan
+
+
+# Compare source NFS export records of a replicated root with the target snapshot
+# Exports whose export path is in source_keys exist on the primary cluster, they are not deleted from this root as
+# they may have moved to another replicated root
+def plan_nfs(logging, records, root, path_trie, snapshot, mirror_deletes=False, applied=None, source_keys=()):
+    plan = []
+    for record in records:
+        digest = record_digest(record)
+        export = record.data
+        src_root, dst_path = translate_path(path_trie, record.path)
+        source = dict(export, fs_path=dst_path)
+        target = snapshot['nfs'].get(export['export_path'])
+        if already_applied(applied, record, digest) and target is not None:
+            action = 'noop'
+        elif target is None:
+            action = 'create'
+        elif normalize_object(source, NFS_FIELDS) != normalize_object(target, NFS_FIELDS):
+            action = 'update'
+        else:
+            action = 'noop'
+        plan.append(plan_entry('nfs', action, export['export_path'], root, source, target, digest))
+    if mirror_deletes:
+        plan.extend(plan_deletions('nfs', root, path_trie, snapshot,
+                                   {entry['key'] for entry in plan}.union(source_keys), 'export_path'))
+    return plan
 
 
-# Replicate quotas from source to target cluster
-def replicate_quotas(prc, src, logging, src_file, path_translation, date_suffix):
+# Compare source SMB share records of a replicated root with the target snapshot, permissions are already translated
+# Shares whose name is in source_keys exist on the primary cluster, they are not deleted from this root as they may
+# have moved to another replicated root
+def plan_smb(logging, records, root, path_trie, snapshot, mirror_deletes=False, applied=None, source_keys=()):
+    plan = []
+    for record in records:
+        digest = record_digest(record)
+        share = record.data
+        # API sends fs_path without trailing /, it is kept that way
+        src_root, dst_path = translate_path(path_trie, record.path)
+        source = dict(share, fs_path=dst_path)
+        target = snapshot['smb'].get(share['share_name'])
+        if already_applied(applied, record, digest) and target is not None:
+            action = 'noop'
+        elif target is None:
+            action = 'create'
+        elif normalize_object(source, SMB_FIELDS) != normalize_object(target, SMB_FIELDS):
+            action = 'update'
+        else:
+            action = 'noop'
+        plan.append(plan_entry('smb', action, share['share_name'], root, source, target, digest))
+    if mirror_deletes:
+        plan.extend(plan_deletions('smb', root, path_trie, snapshot,
+                                   {entry['key'] for entry in plan}.union(source_keys), 'share_name'))
+    return plan
+
+
+# Build the result reported for each replicated object
+# action is created, updated, deleted or unchanged, error is set when the action failed
+# object_id is the id of the object on the target when it is known
+def object_result(object_type, key, action, err=None, object_id=None):
+    return {'type': object_type, 'key': key, 'action': action, 'status': 'ok' if err is None else 'error',
+            'error': None if err is None else str(err), 'id': object_id}
+
+
+# Log a summary of the results of a replicate_* function
+def log_results(logging, caller, results):
+    counts = {}
+    for result in results:
+        name = result['action'] if result['status'] == 'ok' else '{} failed'.format(result['action'])
+        counts[name] = counts.get(name, 0) + 1
+    logging.info('{}, {} objects processed : {}'.format(
+        caller, len(results), ', '.join('{} {}'.format(count, name) for name, count in sorted(counts.items()))))
+
+
+# Apply a quota plan entry on the target cluster, rc is the session of the worker running it
+def apply_quota(rc, logging, entry, src_paths):
+    log = object_logger(logging)
+    dst_path = entry['key']
+    fields = {'type': 'quotas', 'root': entry['root'], 'key': dst_path, 'action': entry['action']}
+    if entry['action'] == 'delete':
+        try:
+            rc.quota.delete_quota(entry['target']['id'])
+            log.debug('replicate_quotas, Quota on target path %s was deleted', dst_path, extra=fields)
+            return object_result('quotas', dst_path, 'deleted')
+        except Exception as err:
+            log.error('replicate_quotas, There was an issue : Quota on target path %s was not deleted', dst_path,
+                      extra=fields)
+            log.error('replicate_quotas, Error message is %s', err.__dict__, extra=fields)
+            return object_result('quotas', dst_path, 'deleted', err)
+    quota = entry['source']
+    if entry['action'] == 'update':
+        log.debug('replicate_quotas, Quota limit on source path %s differs from limit on target path %s (%s != %s)',
+                  quota['source_path'], dst_path, quota['limit'], entry['target']['limit'], extra=fields)
+        # Updating quota on target cluster
+        try:
+            response = rc.quota.update_quota(entry['target'].get('id') or src_paths.id(dst_path, rc=rc),
+                                             quota['limit'])
+            log.debug('replicate_quotas, Quota on target path %s was updated, new limit is %s bytes', dst_path,
+                      response['limit'], extra=fields)
+            return object_result('quotas', dst_path, 'updated')
+        except Exception as err:
+            log.error('replicate_quotas, There was an issue : Quota on target path %s was not updated', dst_path,
+                      extra=fields)
+            log.error('replicate_quotas, Error message is %s', err.__dict__, extra=fields)
+            return object_result('quotas', dst_path, 'updated', err)
+    log.debug('replicate_quotas : Quota on path %s do not exists on target cluster %s', dst_path, rc.conninfo.host,
+              extra=fields)
+    # The directory must exist on the target before the quota can be created
+    try:
+        dst_id = src_paths.id(dst_path, rc=rc)
+    except Exception as err:
+        log.error('replicate_quotas, There was an issue : Target path %s can not be resolved on cluster %s',
+                  dst_path, rc.conninfo.host, extra=fields)
+        log.error('replicate_quotas, Error message is %s', err.__dict__, extra=fields)
+        return object_result('quotas', dst_path, 'created', err)
+    log.debug('replicate_quotas, Source path %s translated to destination path %s and its id is %s',
+              quota['source_path'], dst_path, dst_id, extra=fields)
+    # Create quota on the target cluster
+    try:
+        response = rc.quota.create_quota(dst_id, quota['limit'])
+        log.debug('replicate_quotas, Quota on target path %s was created, limit is %s bytes', dst_path,
+                  response['limit'], extra=fields)
+        return object_result('quotas', dst_path, 'created', object_id=dst_id)
+    except Exception as err:
+        # The cached id may be stale, resolve the path again next time
+        if classify_error(err) == 'not_found':
+            src_paths.forget(path=dst_path)
+        log.error('replicate_quotas, There was an issue : Quota on target path %s was not created', dst_path,
+                  extra=fields)
+        log.error('replicate_quotas, Error message is %s', err.__dict__, extra=fields)
+        return object_result('quotas', dst_path, 'created', err)
+
+
+# Apply a NFS export plan entry on the target cluster, rc is the session of the worker running it
+def apply_export(rc, logging, entry):
+    log = object_logger(logging)
+    fields = {'type': 'nfs', 'root': entry['root'], 'key': entry['key'], 'action': entry['action']}
+    if entry['action'] == 'delete':
+        export = entry['target']
+        try:
+            rc.nfs.nfs_delete_export(export['id'])
+            log.debug('replicate_nfs, NFS export %s for path %s has been deleted', export['export_path'],
+                      export['fs_path'], extra=fields)
+            return object_result('nfs', entry['key'], 'deleted')
+        except Exception as err:
+            log.error('replicate_nfs, Cannot delete NFS export %s', export['export_path'], extra=fields)
+            log.error('replicate_nfs, Error message is %s', err.__dict__, extra=fields)
+            return object_result('nfs', entry['key'], 'deleted', err)
+    export = entry['source']
+    # Format restriction
+    restrictions = []
+    for restrict in export['restrictions']:
+        restrictions.append(qumulo.rest.nfs.NFSExportRestriction(restrict))
+    if entry['action'] == 'create':
+        log.debug('replicate_nfs, Export path %s do not exists on target cluster %s', export['export_path'],
+                  rc.conninfo.host, extra=fields)
+        # Create the export on target cluster
+        try:
+            response = rc.nfs.nfs_add_export(export_path=export['export_path'],
+                                             fs_path=export['fs_path'],
+                                             description=export['description'], restrictions=restrictions,
+                                             fields_to_present_as_32_bit=export['fields_to_present_as_32_bit'])
+            log.debug('replicate_nfs, NFS export for path %s has been created', export['fs_path'], extra=fields)
+            return object_result('nfs', entry['key'], 'created', object_id=response['id'])
+        except Exception as err:
+            log.error('replicate_nfs, Cannot create NFS export for path %s', export['fs_path'], extra=fields)
+            log.error('replicate_nfs, Error message is %s', err.__dict__, extra=fields)
+            return object_result('nfs', entry['key'], 'created', err)
+    # Translate source export id to target export id and then update the export
+    dst_id = entry['target']['id']
+    log.debug('replicate_nfs, Translating export id for export path %s from id %s to id %s', export['export_path'],
+              export['id'], dst_id, extra=fields)
+    try:
+        rc.nfs.nfs_modify_export(id_=dst_id, export_path=export['export_path'], fs_path=export['fs_path'],
+                                 description=export['description'], restrictions=restrictions,
+                                 fields_to_present_as_32_bit=export['fields_to_present_as_32_bit'])
+        log.debug('replicate_nfs, NFS export id %s for path %s has been updated', dst_id, export['fs_path'],
+                  extra=fields)
+        return object_result('nfs', entry['key'], 'updated')
+    except Exception as err:
+        log.error('replicate_nfs, Cannot update NFS export id %s for path %s ', dst_id, export['fs_path'],
+                  extra=fields)
+        log.error('replicate_nfs, Error message is %s', err.__dict__, extra=fields)
+        return object_result('nfs', entry['key'], 'updated', err)
+
+
+# Apply a SMB share plan entry on the target cluster, rc is the session of the worker running it
+def apply_share(rc, logging, entry):
+    log = object_logger(logging)
+    fields = {'type': 'smb', 'root': entry['root'], 'key': entry['key'], 'action': entry['action']}
+    if entry['action'] == 'delete':
+        share = entry['target']
+        try:
+            rc.smb.smb_delete_share(share['id'])
+            log.debug('replicate_smb, SMB Share %s for path %s has been deleted', share['share_name'],
+                      share['fs_path'], extra=fields)
+            return object_result('smb', entry['key'], 'deleted')
+        except Exception as err:
+            log.error('replicate_smb, Cannot delete SMB Share %s', share['share_name'], extra=fields)
+            log.error('replicate_smb, Error message is %s', err.__dict__, extra=fields)
+            return object_result('smb', entry['key'], 'deleted', err)
+    share = entry['source']
+    if entry['action'] == 'create':
+        log.debug('replicate_smb, Share %s do not exists on target cluster %s', share['share_name'],
+                  rc.conninfo.host, extra=fields)
+        # Create the share on target cluster
+        try:
+            response = rc.smb.smb_add_share(share_name=share['share_name'],
+                                            fs_path=share['fs_path'],
+                                            description=share['description'],
+                                            read_only=None,
+                                            allow_guest_access=None,
+                                            allow_fs_path_create=False,
+                                            access_based_enumeration_enabled=share['access_based_enumeration_enabled'],
+                                            default_file_create_mode=share['default_file_create_mode'],
+                                            default_directory_create_mode=share['default_directory_create_mode'],
+                                            permissions=share['permissions'],
+                                            require_encryption=share['require_encryption'],
+                                            network_permissions=share['network_permissions'])
+            log.debug('replicate_smb, SMB Share %s for path %s has been created', share['share_name'],
+                      share['fs_path'], extra=fields)
+            return object_result('smb', entry['key'], 'created', object_id=response['id'])
+        except Exception as err:
+            log.error('replicate_smb, Cannot create SMB Share %s for path %s', share['share_name'],
+                      share['fs_path'], extra=fields)
+            log.error('replicate_smb, Error message is %s', err.__dict__, extra=fields)
+            return object_result('smb', entry['key'], 'created', err)
+    try:
+        rc.smb.smb_modify_share(old_name=share['share_name'],
+                                fs_path=share['fs_path'],
+                                description=share['description'],
+                                allow_fs_path_create=False,
+                                access_based_enumeration_enabled=share['access_based_enumeration_enabled'],
+                                default_file_create_mode=share['default_file_create_mode'],
+                                default_directory_create_mode=share['default_directory_create_mode'],
+                                permissions=share['permissions'],
+                                require_encryption=share['require_encryption'],
+                                network_permissions=share['network_permissions'])
+        log.debug('replicate_smb, SMB Share %s for path %s has been updated', share['share_name'], share['fs_path'],
+                  extra=fields)
+        return object_result('smb', entry['key'], 'updated')
+    except Exception as err:
+        log.error('replicate_smb, Cannot update SMB Share %s for path %s ', share['share_name'], share['fs_path'],
+                  extra=fields)
+        log.error('replicate_smb, Error message is %s', err.__dict__, extra=fields)
+        return object_result('smb', entry['key'], 'updated', err)
+
+
+# Keep the target snapshot in line with a plan entry successfully applied
+# Objects are indexed again under the target root of their new path, an update may move them to another root
+def update_target_snapshot(snapshot, entry, result):
+    index = snapshot[entry['type']]
+    if entry['target'] is not None:
+        fs_path = entry['key'] if entry['type'] == 'quotas' else entry['target']['fs_path']
+        for scoped in snapshot['roots'].values():
+            objects = scoped.get(entry['type'], {}).get(fs_path, [])
+            if entry['target'] in objects:
+                objects.remove(entry['target'])
+    if entry['action'] == 'delete':
+        index.pop(entry['key'], None)
+        return
+    target = dict(entry['target'] or {}, **entry['source'])
+    if result['id'] is not None:
+        target['id'] = result['id']
+    index[entry['key']] = target
+    fs_path = entry['key'] if entry['type'] == 'quotas' else target['fs_path']
+    dst_root, dst_path = translate_path(snapshot['trie'], fs_path)
+    if dst_root is not None:
+        snapshot['roots'][dst_root].setdefault(entry['type'], {}).setdefault(fs_path, []).append(target)
+
+
+# Apply a plan on the target cluster using up to workers parallel sessions
+# noop entries are reported as unchanged without any call to the target cluster
+# The target snapshot and the applied records (see already_applied) are updated with the entries applied,
+# journal(entry, result) is called by the worker as soon as each of them is applied
+# Each change is logged with its result and duration, unchanged objects only if log_noop_sample keeps them
+def apply_plan(src, logging, plan, src_paths, workers=1, snapshot=None, applied=None, journal=None):
+    log = object_logger(logging)
+    appliers = {'quotas': lambda rc, entry: apply_quota(rc, logging, entry, src_paths),
+                'nfs': lambda rc, entry: apply_export(rc, logging, entry),
+                'smb': lambda rc, entry: apply_share(rc, logging, entry)}
+
+    def apply(rc, entry):
+        started = time.monotonic()
+        result = appliers[entry['type']](rc, entry)
+        result['seconds'] = round(time.monotonic() - started, 6)
+        if journal is not None:
+            journal(entry, result)
+        return result
+
+    changes = [entry for entry in plan if entry['action'] != 'noop']
+    results = run_concurrently(src, apply, changes, workers)
+    for entry, result in zip(changes, results):
+        log.log(logging.INFO if result['status'] == 'ok' else logging.ERROR,
+                'apply_plan, %s %s %s %s in %ss', entry['type'], entry['key'], result['action'], result['status'],
+                result['seconds'], extra={'type': entry['type'], 'root': entry['root'], 'key': entry['key'],
+                                          'action': result['action'], 'status': result['status'],
+                                          'seconds': result['seconds']})
+        if result['status'] == 'ok' and snapshot is not None:
+            update_target_snapshot(snapshot, entry, result)
+        if applied is not None and entry['digest'] is not None:
+            if result['status'] == 'ok':
+                applied[(entry['type'], entry['root'], entry['key'])] = entry['digest']
+            else:
+                applied.pop((entry['type'], entry['root'], entry['key']), None)
+    sampled = is_noop_logged(logging, log)
+    for entry in plan:
+        if entry['action'] == 'noop':
+            results.append(object_result(entry['type'], entry['key'], 'unchanged'))
+            if sampled:
+                log.info('apply_plan, %s %s unchanged', entry['type'], entry['key'],
+                         extra={'type': entry['type'], 'root': entry['root'], 'key': entry['key'],
+                                'action': 'unchanged', 'status': 'ok'})
+            if applied is not None:
+                applied[(entry['type'], entry['root'], entry['key'])] = entry['digest']
+    return results
+
+
+# Replicate quota records from source to target cluster, only quotas missing or different on the target are written
+def replicate_quotas(src, logging, records, path, path_trie, src_paths, snapshot, workers=1, mirror_deletes=False,
+                     applied=None, journal=None):
     logging.info(
-        'replicate_quotas, Start replicating quotas from file {}'.format(src_file))
-    # Parse json source quota file
-    with open(src_file) as src_json:
-        src_data = json.loads(src_json.read())
-        for quota in src_data:
-            src_path = convert_id_to_path(prc, logging, quota['id'])
-            dst_path = src_path
-            logging.info(
-                'replicate_quotas, Source quota on path {} (id : {}) has the following limit : {} bytes'.
-                format(src_path, quota['id'], quota['limit']))
-            # Convert source path to destination path and retrieve id from target
-            for sdir, ddir in path_translation.items():
-                if sdir in src_path:
-                    dst_path = dst_path.replace(sdir, ddir)
-            dst_id = convert_path_to_id(src, logging, dst_path)
-            logging.info(
-                'replicate_quotas, Source path {} translated to destination path {} and its id is {}'.
-                format(src_path, dst_path, dst_id))
-            # Check if quota already exists on target cluster
-            try:
-                check_quota = src.quota.get_quota_with_status(dst_id)
-                logging.info(
-                    'replicate_quotas, Quota on path {} already exists on target cluster {} and its limit is {} bytes'.
-                    format(dst_path, src.conninfo.host, check_quota['limit']))
-                # If source limits differs from target limit, update the quota on target cluster
-                if quota['limit'] != check_quota['limit']:
-                    logging.info(
-                        'replicate_quotas, Quota limit on source path {} differs from limit on target path {} ({} != '
-                        '{})'.format(src_path, dst_path, quota['limit'], check_quota['limit']))
-                    # Updating quota on target cluster
-                    try:
-                        response = src.quota.update_quota(dst_id, quota['limit'])
-                        logging.info(
-                            'replicate_quotas, Quota on target path {} was updated, new limit is {} bytes'.
-                            format(dst_path, response['limit']))
-                    except Exception as err:
-                        logging.error(
-                            'replicate_quotas, There was an issue : Quota on target path {} was not updated'.
-                            format(dst_path))
-                        logging.error(
-                            'replicate_quotas, Error message is {}'.format(err.__dict__))
-                else:
-                    logging.info(
-                        'replicate_quotas, Quota limit on source path {} target path {} are the same ({}), leave it '
-                        'unchanged'.format(src_path, dst_path, quota['limit']))
-            # If quota do not exists, RestClient returns a 404 code, handled as exception
-            except Exception as err:
-                logging.info(
-                    'replicate_quotas : Quota on path {} do not exists on target cluster {}'.
-                    format(dst_path, src.conninfo.host))
-                # Create quota on the target cluster
-                try:
-                    response = src.quota.create_quota(dst_id, quota['limit'])
-                    logging.info(
-                        'replicate_quotas, Quota on target path {} was created, limit is {} bytes'.
-                        format(dst_path, response['limit']))
-                except Exception as err:
-                    logging.error(
-                        'replicate_quotas, There was an issue : Quota on target path {} was not created'.
-                        format(dst_path))
-                    logging.error(
-                        'replicate_quotas, Error message is {}'.format(err.__dict__))
+        'replicate_quotas, Start replicating quotas of path {}'.format(path))
+    plan = plan_quotas(logging, records, path, path_trie, snapshot, mirror_deletes, applied)
+    results = apply_plan(src, logging, plan, src_paths, workers, snapshot, applied, journal)
+    log_results(logging, 'replicate_quotas', results)
     logging.info(
-        'replicate_quotas, End replicating quotas from file {}'.format(src_file))
-    archive_file(src_file, logging, date_suffix)
+        'replicate_quotas, End replicating quotas of path {}'.format(path))
+    return results
 
 
-# Replication NFS exports from source to target cluster
-def replicate_nfs(src, logging, src_file, path_translation, date_suffix):
+# Replication NFS export records from source to target cluster, only exports missing or different on the target
+# are written
+def replicate_nfs(src, logging, records, path, path_trie, snapshot, workers=1, mirror_deletes=False, applied=None,
+                  journal=None, source_keys=()):
     logging.info(
-        'replicate_nfs, Start replicating NFS exports from file {}'.format(src_file))
-    # Parse json source nfs file
-    with open(src_file) as src_json:
-        src_data = json.loads(src_json.read())
-        for export in src_data:
-            # Check if export already exists on target cluster
-            try:
-                dst_export = src.nfs.nfs_get_export(export['export_path'])
-                logging.info(
-                    'replicate_nfs, Export path {} already exists on target cluster {}'.
-                    format(export['export_path'], src.conninfo.host))
-                # If so, translate source export id to target export id and then update the export
-                logging.info(
-                    'replicate_nfs, Translating export id for export path {} from id {} to id {}'.
-                    format(export['export_path'], export['id'], dst_export['id']))
-                export['id'] = dst_export['id']
-                # Convert source path to destination path
-                dst_path = export['fs_path']
-                for sdir, ddir in path_translation.items():
-                    if sdir in export['fs_path']:
-                        dst_path = dst_path.replace(sdir, ddir)
-                # update the export on target cluster
-                try:
-                    # Format restriction
-                    restrictions = []
-                    for restrict in export['restrictions']:
-                        restrictions.append(qumulo.rest.nfs.NFSExportRestriction(restrict))
-                    src.nfs.nfs_modify_export(id_=export['id'], export_path=export['export_path'], fs_path=dst_path,
-                                              description=export['description'], restrictions=restrictions,
-                                              fields_to_present_as_32_bit=export['fields_to_present_as_32_bit'])
-                    logging.info(
-                        'replicate_nfs, NFS export id {} for path {} has been updated'.
-                        format(dst_export['id'], export['fs_path']))
-                except Exception as err:
-                    logging.error(
-                        'replicate_nfs, Cannot update NFS export id {} for path {} '.
-                        format(dst_export['id'], export['fs_path']))
-                    logging.error(
-                        'replicate_nfs, Error message is {}'.format(err.__dict__))
+        'replicate_nfs, Start replicating NFS exports of path {}'.format(path))
+    plan = plan_nfs(logging, records, path, path_trie, snapshot, mirror_deletes, applied, source_keys)
+    results = apply_plan(src, logging, plan, None, workers, snapshot, applied, journal)
+    log_results(logging, 'replicate_nfs', results)
+    return results
 
-            except Exception as err:
-                logging.info(
-                    'replicate_nfs, Export path {} do not exists on target cluster {}'.
-                    format(export['export_path'], src.conninfo.host))
-                # Create the export on target cluster
-                try:
-                    # Format restriction
-                    restrictions = []
-                    for restrict in export['restrictions']:
-                        restrictions.append(qumulo.rest.nfs.NFSExportRestriction(restrict))
-                    # Convert source path to destination path
-                    dst_path = export['fs_path']
-                    for sdir, ddir in path_translation.items():
-                        if sdir in export['fs_path']:
-                            dst_path = dst_path.replace(sdir, ddir)
-                    src.nfs.nfs_add_export(export_path=export['export_path'],
-                                           fs_path=dst_path,
-                                           description=export['description'], restrictions=restrictions,
-                                           fields_to_present_as_32_bit=export['fields_to_present_as_32_bit'])
-                    logging.info(
-                        'replicate_nfs, NFS export for path {} has been created'.
-                        format(export['fs_path']))
-                except Exception as err:
-                    logging.error(
-                        'replicate_nfs, Cannot create NFS export for path {}'.
-                        format(export['fs_path']))
-                    logging.error(
-                        'replicate_nfs, Error message is {}'.format(err.__dict__))
-    archive_file(src_file, logging, date_suffix)
-
-# Replication SMB shares from source to target cluster
-def replicate_smb(src, logging, src_file, path_translation, date_suffix):
+
+# Replication SMB share records from source to target cluster, only shares missing or different on the target
+# are written
+def replicate_smb(src, logging, records, path, path_trie, snapshot, workers=1, mirror_deletes=False, applied=None,
+                  journal=None, source_keys=()):
     logging.info(
-        'replicate_smb, Start replicating SMB Shares from file {}'.format(src_file))
-    # Parse json source SMB file
-    with open(src_file) as src_json:
-        src_data = json.loads(src_json.read())
-        for share in src_data:
-            # Check if share already exists on target cluster
-            try:
-                dst_share = src.smb.smb_list_share(share['share_name'])
-                logging.info(
-                    'replicate_smb, Share {} already exists on target cluster {}'.
-                    format(share['share_name'], src.conninfo.host))
-                # Convert source path to destination path (removing trailing / cause API sends fs_path without it)
-                dst_path = share['fs_path']
-                for sdir, ddir in path_translation.items():
-                    if sdir.rstrip('/') in share['fs_path']:
-                        dst_path = dst_path.replace(sdir.rstrip('/'), ddir.rstrip('/'))
-                try:
-                    src.smb.smb_modify_share(old_name=share['share_name'],
-                                             fs_path=dst_path,
-                                             description=share['description'],
-                                             allow_fs_path_create=False,
-                                             access_based_enumeration_enabled=share['access_based_enumeration_enabled'],
-                                             default_file_create_mode=share['default_file_create_mode'],
-                                             default_directory_create_mode=share['default_directory_create_mode'],
-                                             permissions=share['permissions'],
-                                             require_encryption=share['require_encryption'],
-                                             network_permissions=share['network_permissions'])
-                    logging.info(
-                        'replicate_smb, SMB Share {} for path {} has been updated'.
-                        format(share['share_name'], dst_path))
-                except Exception as err:
-                    print(err)
-                    logging.error(
-                        'replicate_smb, Cannot update SMB Share {} for path {} '.
-                        format(share['share_name'], dst_path))
-                    logging.error(
-                        'replicate_smb, Error message is {}'.format(err.__dict__))
+        'replicate_smb, Start replicating SMB Shares of path {}'.format(path))
+    plan = plan_smb(logging, records, path, path_trie, snapshot, mirror_deletes, applied, source_keys)
+    results = apply_plan(src, logging, plan, None, workers, snapshot, applied, journal)
+    log_results(logging, 'replicate_smb', results)
+    return results
+
+
+# Optional settings of credentials.json and their default value
+DEFAULT_SETTINGS = {
+    'path_cache_ttl': 0,
+    'resolver_workers': 8,
+    'cluster_cache_ttl': 0,
+    'connect_timeout': 10,
+    'replication_workers': 4,
+    'mirror_deletes': False,
+    'write_snapshots': True,
+    'versions_keep_runs': 100,
+    'versions_keep_days': 0,
+    'versions_compact_hours': 24,
+    'sync_interval': 60,
+    'relationships_refresh_cycles': 10,
+    'target_refresh_cycles': 10,
+    'metrics_file': 'q-replicate-config-metrics.json',
+    'prometheus_file': '',
+    'max_concurrency': 16,
+    'max_rate': 0.0,
+    'retries': 5,
+    'retry_base_delay': 0.5,
+    'retry_max_delay': 30.0,
+    'quota_page_size': 1000,
+    'sync_types': list(OBJECT_TYPES),
+    'sync_paths': [],
+    'activity_gating': False,
+    'fingerprint_ttl': 0,
+    'log_format': 'text',
+    'object_log_level': 'INFO',
+    'log_noop_sample': 0.0,
+    'gather_workers': 4,
+}
+
+
+# Returns the optional settings of credentials.json, with their default value when they are not set
+def load_settings(json_object):
+    settings = {}
+    for name, default in DEFAULT_SETTINGS.items():
+        value = json_object.get(name, default)
+        # Lists can also be given as comma separated strings
+        if isinstance(default, list) and isinstance(value, str):
+            value = [item.strip() for item in value.split(',') if item.strip()]
+        settings[name] = value if isinstance(default, bool) else type(default)(value)
+    settings['object_log_level'] = settings['object_log_level'].upper()
+    if not isinstance(logging.getLevelName(settings['object_log_level']), int):
+        raise ValueError('Unknown object_log_level : {}'.format(settings['object_log_level']))
+    if settings['log_format'] not in ('text', 'json'):
+        raise ValueError('Unknown log_format : {}'.format(settings['log_format']))
+    unknown_types = set(settings['sync_types']) - set(OBJECT_TYPES)
+    if unknown_types:
+        raise ValueError('Unknown object types in sync_types : {}'.format(', '.join(sorted(unknown_types))))
+    return settings
+
+
+# Returns the target clusters of credentials.json : the secondary cluster, then the clusters listed in targets
+# Each target is a dict with address, port_number, username and password, secondary is True for the secondary
+# cluster
+def load_targets(json_object):
+    targets = []
+    if json_object.get('secondary_cluster_address'):
+        targets.append({'address': json_object['secondary_cluster_address'],
+                        'port_number': json_object['secondary_port_number'],
+                        'username': json_object['secondary_username'],
+                        'password': json_object['secondary_password'], 'secondary': True})
+    for target in json_object.get('targets', []):
+        targets.append({'address': target['cluster_address'], 'port_number': target['port_number'],
+                        'username': target['username'], 'password': target['password'], 'secondary': False})
+    return targets
+
 
+# Returns a translation table source root path -> target root path per target cluster id, built from the
+# replications configured on the primary cluster, replications to other clusters are ignored
+# all_repl are the relationship statuses of the primary cluster when they were already retrieved
+def discover_relationships(prc, logging, targets, settings, all_repl=None):
+    # Get All Replication configured on primary cluster
+    if all_repl is None:
+        all_repl = prc.replication.list_source_relationship_statuses()
+    # Identify the cluster behind each target address, every distinct address is checked once
+    # Addresses not identified with the credentials of a target are checked with the ones of the next target
+    known = {target.address: target.cluster_id for target in targets}
+    address_cluster_ids = {}
+    for target in targets:
+        unidentified = [repl['target_address'] for repl in all_repl
+                        if address_cluster_ids.get(repl['target_address']) is None]
+        if not unidentified:
+            break
+        address_cluster_ids.update(identify_addresses(unidentified, target.credentials['port_number'],
+                                                      target.credentials['username'],
+                                                      target.credentials['password'], logging, known=known,
+                                                      cache_ttl=settings['cluster_cache_ttl'],
+                                                      timeout=settings['connect_timeout']))
+    # Extract only replications where target is one of the target clusters
+    path_translations = {target.cluster_id: {} for target in targets}
+    for repl in all_repl:
+        cluster_id = address_cluster_ids.get(repl['target_address'])
+        if cluster_id in path_translations:
+            logging.info(
+                'main,  Replication id {} has target ip {} and will be processed'.format(repl['id'],
+                                                                                         repl['target_address']))
+            path_translations[cluster_id][repl['source_root_path']] = repl['target_root_path']
+            logging.info(
+                'main, Source path to be processed is {} and its target path is {}'.format(repl['source_root_path'],
+                                                                                           repl['target_root_path']))
+        else:
+            logging.info(
+                'main,  Replication id {} has target ip {} and won\'t processed'.format(repl['id'],
+                                                                                        repl['target_address']))
+    return path_translations
+
+
+# What is kept for a target cluster between two synchronizations : authenticated sessions, id <-> path and
+# identity caches, replication relationships, target snapshot and source objects already applied on it
+# It has its own session on the primary cluster so targets can be synchronized concurrently
+class TargetState:
+    def __init__(self, prc, src, logging, credentials, settings, metrics, versions_path='./versions'):
+        self.src = InstrumentedClient(src, metrics, Transport(src, logging, metrics, settings))
+        self.cluster_id = get_cluster_id(self.src, logging)
+        self.prc = prc.clone()
+        self.address = credentials['address']
+        self.credentials = credentials
+        self.versions_path = versions_path
+        self.src_paths = PathResolver(self.src, logging, self.cluster_id, settings['path_cache_ttl'],
+                                      settings['resolver_workers'])
+        self.identities = None
+        # Replicated paths to this cluster, source root -> target root, path_translation only keeps the ones
+        # synchronized by the current cycle (sync_paths, activity_gating)
+        self.relationships = None
+        self.path_translation = None
+        self.path_trie = None
+        # Digest of the relationships activity of each replicated path, see relationship_activity, and the
+        # replicated paths with an object that failed during the current cycle, their activity is not recorded
+        self.activity = None
+        self.failed_paths = set()
+        # Fingerprints of the objects last verified on this cluster, object type -> replicated path ->
+        # [fingerprint, time], and the ones verified by the current cycle, (object type, path) -> fingerprint
+        self.fingerprints = {}
+        self.verified = {}
+        self.target_snapshot = None
+        self.applied = None
+        # Objects of an interrupted run already written on this target, see RunJournal
+        self.resumed = {}
+        self.journal = None
+
+
+# What is kept between two synchronizations : the primary cluster session, its id <-> path cache, the run
+# journal and the state of each target cluster
+# resume is set to skip the objects an interrupted run already wrote, see RunJournal
+# targets is a list of (target credentials, RestClient logged in on it or None if it could not be reached), calls
+# made through the sessions are recorded in metrics ; targets that could not be reached or identified are
+# connected again before each synchronization with connect(credentials), see connect_target
+class SyncState:
+    def __init__(self, prc, targets, logging, settings, connect=None):
+        self.metrics = RunMetrics()
+        self.prc = InstrumentedClient(prc, self.metrics, Transport(prc, logging, self.metrics, settings))
+        self.logging = logging
+        self.settings = settings
+        # Id <-> path resolution is shared by every replicated path, every target and every synchronization
+        self.cluster_id = get_cluster_id(self.prc, logging)
+        self.prc_paths = PathResolver(self.prc, logging, self.cluster_id, settings['path_cache_ttl'],
+                                      settings['resolver_workers'])
+        self.connect = connect
+        self.targets = []
+        # Credentials of the targets not connected yet
+        self.pending = []
+        for credentials, src in targets:
+            self.add_target(credentials, src)
+        self.journal = RunJournal(logging, './cache/journal-{}.jsonl'.format(self.cluster_id))
+        # Position of the next page of quotas of an interrupted enumeration, see sync_quotas
+        self.quota_cursor_file = './cache/quotas-{}.json'.format(self.cluster_id)
+        # Relationships activity of the last successful synchronization of each target, see activity_gating
+        self.activity_file = './cache/activity-{}.json'.format(self.cluster_id)
+        self.relationship_layout = None
+        # Fingerprints of the objects last verified on each target, see fingerprint_ttl, verify ignores them
+        self.fingerprints_file = './cache/fingerprints-{}.json'.format(self.cluster_id)
+        self.verify = False
+        self.resume = False
+        self.cycle = 0
+        self.last_metrics = None
+
+    # Identify a target cluster and synchronize it from now on, it is left pending if src is None or if it can not
+    # be identified
+    # The secondary cluster keeps ./versions, the other targets get ./versions-<cluster id>, whichever targets
+    # could be reached
+    def add_target(self, credentials, src):
+        if src is not None:
+            try:
+                target = TargetState(self.prc, src, self.logging, credentials, self.settings, self.metrics)
+                if not credentials.get('secondary'):
+                    target.versions_path = './versions-{}'.format(target.cluster_id)
+                self.targets.append(target)
+                return
             except Exception as err:
-                logging.info(
-                    'replicate_smb, Share {} do not exists on target cluster {}'.
-                    format(share['share_name'], src.conninfo.host))
-                # Create the share on target cluster
-                try:
-                    # Convert source path to destination path (removing trailing / cause API sends fs_path without it)
-                    dst_path = share['fs_path']
-                    for sdir, ddir in path_translation.items():
-                        if sdir.rstrip('/') in share['fs_path']:
-                            dst_path = dst_path.replace(sdir.rstrip('/'), ddir.rstrip('/'))
-                    src.smb.smb_add_share(share_name=share['share_name'],
-                                          fs_path=dst_path,
-                                          description=share['description'],
-                                          read_only=None,
-                                          allow_guest_access=None,
-                                          allow_fs_path_create=False,
-                                          access_based_enumeration_enabled=share['access_based_enumeration_enabled'],
-                                          default_file_create_mode=share['default_file_create_mode'],
-                                          default_directory_create_mode=share['default_directory_create_mode'],
-                                          permissions=share['permissions'],
-                                          require_encryption=share['require_encryption'],
-                                          network_permissions=share['network_permissions'])
-                    logging.info(
-                        'replicate_smb, SMB Share {} for path {} has been created'.
-                        format(share['share_name'], share['fs_path']))
-                except Exception as err:
-                    logging.error(
-                        'replicate_smb, Cannot create SMB Share {} for path {}'.
-                        format(share['share_name'], dst_path))
-                    logging.error(
-                        'replicate_smb, Error message is {}'.format(err.__dict__))
-    archive_file(src_file, logging, date_suffix)
\ No newline at end of file
+                self.logging.error('SyncState, Can not identify cluster {}, it will be tried again next time'.format(
+                    credentials['address']))
+                self.logging.error('SyncState, Error message is {}'.format(err))
+                src.close()
+        self.pending.append(credentials)
+
+    # Connect again the targets that could not be reached or identified, relationships are discovered again when
+    # one of them joins as it has none yet
+    def connect_targets(self):
+        if not self.pending or self.connect is None:
+            return
+        pending, self.pending = self.pending, []
+        for credentials in pending:
+            self.add_target(credentials, self.connect(credentials))
+
+    # Force relationships, identities and target snapshots to be retrieved again on next synchronization
+    def reset(self):
+        for target in self.targets:
+            target.relationships = None
+            target.target_snapshot = None
+
+    # Log in again on every cluster, pooled sessions are cloned again with the new credentials
+    def login(self, primary_username, primary_password):
+        self.prc.login(primary_username, primary_password)
+        for target in self.targets:
+            target.prc.close()
+        self.prc.transport.reset()
+        for target in self.targets:
+            target.prc = self.prc.clone()
+            target.src.login(target.credentials['username'], target.credentials['password'])
+            target.src.transport.reset()
+
+    def close(self):
+        for target in self.targets:
+            target.prc.close()
+            target.src.close()
+        self.prc.close()
+
+
+# Returns True every cycles synchronizations, never if cycles is 0
+def is_refresh_cycle(cycle, cycles):
+    return bool(cycles) and cycle % cycles == 0
+
+
+# Add results to counts, a dict type|action|status -> number of objects
+def count_results(results, counts):
+    for result in results:
+        name = '{}|{}|{}'.format(result['type'], result['action'], result['status'])
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+# Add results of the objects of a replicated path to counts, the path is remembered as failed on the target if
+# one of them is not ok
+def count_path_results(target, path, results, counts):
+    if any(result['status'] != 'ok' for result in results):
+        target.failed_paths.add(path)
+    return count_results(results, counts)
+
+
+# Run func(target) for each target, concurrently if there are several, and returns a list of
+# (target, result of func, error) ; a target failing with a ReplicationError does not stop the others and its
+# snapshot is retrieved again next time
+def run_on_targets(state, targets, func):
+    phase = state.metrics.current_phase()
+
+    def run_one(target):
+        try:
+            with state.metrics.phase(phase, timed=False):
+                return target, func(target), None
+        except ReplicationError as err:
+            state.logging.error('sync_cycle, Synchronization of cluster {} failed : {}'.format(target.address, err))
+            target.target_snapshot = None
+            return target, None, err
+
+    if len(targets) <= 1:
+        return [run_one(target) for target in targets]
+    with ThreadPoolExecutor(max_workers=len(targets)) as pool:
+        return list(pool.map(run_one, targets))
+
+
+# Retrieve the snapshots of the targets and, meanwhile, the SMB shares and NFS exports of the primary cluster
+# (object types in sync_types, nothing without targets) and the local identities SMB shares are translated with ;
+# returns the outcomes of the targets (see run_on_targets) and the primary cluster inventory
+def gather(state, targets):
+    settings = state.settings
+    kinds = [kind for kind in ('smb', 'nfs') if kind in settings['sync_types'] and targets]
+
+    def gather_primary():
+        with state.metrics.phase('gather'):
+            return get_inventory(state.prc, state.logging, state.prc_paths, kinds, settings['quota_page_size'],
+                                 settings['gather_workers'])
+
+    def prefill(target):
+        with state.metrics.phase('gather', timed=False):
+            target.identities.ensure_prefilled()
+
+    with ThreadPoolExecutor(max_workers=1 + len(targets)) as pool:
+        inventory = pool.submit(gather_primary)
+        identities = [pool.submit(prefill, target) for target in targets if 'smb' in kinds]
+        with state.metrics.phase('target'):
+            outcomes = run_on_targets(state, targets, lambda target: refresh_target(state, target))
+        for prefilled in identities:
+            prefilled.result()
+        return outcomes, inventory.result()
+
+
+# Retrieve SMB shares, NFS exports and quotas of the target cluster if it has to be compared again
+def refresh_target(state, target):
+    if target.target_snapshot is None or is_refresh_cycle(state.cycle, state.settings['target_refresh_cycles']):
+        # Retrieve SMB shares, NFS exports and quotas of the target cluster once to compare them with the source
+        target.target_snapshot = get_target_snapshot(target.src, state.logging, target.src_paths,
+                                                     target.relationships, state.settings['quota_page_size'],
+                                                     state.settings['sync_types'], state.settings['gather_workers'])
+        # Every object is compared again with the new snapshot
+        target.applied = {}
+    # Objects an interrupted run wrote are skipped if they are still as they were written, as already applied
+    target.applied.update(target.resumed)
+
+
+# Replicate a page of quotas of the primary cluster to a target cluster, returns the counts of results
+# Target paths of the quotas are added to kept, per replicated path, when mirror_deletes is set
+def replicate_quota_page(state, target, quotas, snapshots, kept):
+    settings = state.settings
+    records = {}
+    for record in snapshots.tap(get_quotas(state.logging, target.path_trie, quotas)):
+        records.setdefault(record.root, []).append(record)
+    counts = {}
+    for path, path_records in records.items():
+        results = replicate_quotas(target.src, state.logging, path_records, path, target.path_trie,
+                                   target.src_paths, target.target_snapshot, settings['replication_workers'],
+                                   False, target.applied, target.journal)
+        count_path_results(target, path, results, counts)
+        if kept is not None:
+            kept.setdefault(path, set()).update(translate_path(target.path_trie, record.path)[1]
+                                                for record in path_records)
+    return counts
+
+
+# Returns the cursor of the quotas enumeration an interrupted run saved if state.resume is set, None to start
+# from the first page
+def load_quota_cursor(state):
+    if not state.resume or not os.path.exists(state.quota_cursor_file):
+        return None
+    with open(state.quota_cursor_file) as cursor_json:
+        after = json.load(cursor_json)['next']
+    state.logging.info('load_quota_cursor, Resuming quotas enumeration of {} from {}'.format(
+        state.prc.conninfo.host, after))
+    return after
+
+
+# Stream the quotas of the primary cluster to the targets page by page, each page is applied to all targets
+# before the next one is retrieved so memory does not grow with the number of quotas
+# The cursor of the next page is saved in ./cache/quotas-<cluster id>.json after each page, an interrupted
+# enumeration resumes from the cursor after (see load_quota_cursor) ; quotas of the skipped pages are unknown so
+# none are deleted then
+def sync_quotas(state, targets, snapshots, counts, after=None):
+    settings = state.settings
+    logging = state.logging
+    cursor_file = state.quota_cursor_file
+    mirror_deletes = settings['mirror_deletes'] and after is None
+    kept = {target.address: {} if mirror_deletes else None for target in targets}
+    failed = set()
+    if not targets:
+        return failed
+    # The next page is retrieved while the current one is replicated, until every target failed
+    pages = prefetch(state.metrics, get_quota_pages(state.prc, logging, state.prc_paths, settings['quota_page_size'],
+                                                    after))
+    for cursor, quotas in pages:
+        for target, target_counts, err in run_on_targets(
+                state, [target for target in targets if target.address not in failed],
+                lambda target: replicate_quota_page(state, target, quotas, snapshots[target.address],
+                                                    kept[target.address])):
+            if err is None:
+                for name, count in target_counts.items():
+                    counts[name] = counts.get(name, 0) + count
+            else:
+                failed.add(target.address)
+        if len(failed) == len(targets):
+            break
+        if cursor:
+            write_atomically(cursor_file, json.dumps({'next': cursor}))
+    pages.close()
+    if os.path.exists(cursor_file):
+        os.remove(cursor_file)
+    # Delete the quotas of the target paths that were not in the stream
+    for target in targets:
+        if kept[target.address] is None or target.address in failed:
+            continue
+        for path in target.path_translation:
+            plan = plan_deletions('quotas', path, target.path_trie, target.target_snapshot,
+                                  kept[target.address].get(path, set()), None)
+            results = apply_plan(target.src, logging, plan, target.src_paths, settings['replication_workers'],
+                                 target.target_snapshot, target.applied, target.journal)
+            if results:
+                log_results(logging, 'replicate_quotas', results)
+            count_path_results(target, path, results, counts)
+    return failed
+
+
+# Load the fingerprints of the objects last verified on each target
+def load_fingerprints(state):
+    fingerprints = load_cache_file(state.logging, state.fingerprints_file) if state.settings['fingerprint_ttl'] else {}
+    for target in state.targets:
+        target.fingerprints = fingerprints.get(target.cluster_id, {})
+        target.verified = {}
+
+
+# Returns True if the objects of a type under a replicated path have the fingerprint they had when they were
+# last verified on the target, less than fingerprint_ttl seconds ago
+def is_fingerprint_current(state, target, object_type, path, fingerprint):
+    if not state.settings['fingerprint_ttl'] or state.verify:
+        return False
+    known = target.fingerprints.get(object_type, {}).get(path)
+    return known is not None and known[0] == fingerprint and \
+        time.time() - known[1] < state.settings['fingerprint_ttl']
+
+
+# Returns the fingerprint of the objects of a type under a replicated path, or None if they are unchanged since
+# they were last verified on the target : they are then counted as skipped and recorded in the versions as they
+# were in the last run
+def check_fingerprint(state, target, snapshots, object_type, path, objects, counts):
+    if not state.settings['fingerprint_ttl']:
+        return ''
+    fingerprint = config_fingerprint(object_type, objects, target.path_translation[path],
+                                     state.settings['mirror_deletes'])
+    count = sum(len(all_objects) for all_objects in objects.values())
+    if is_fingerprint_current(state, target, object_type, path, fingerprint) and \
+            snapshots.carry(object_type, path, count):
+        state.logging.info('check_fingerprint, {} {} objects of {} unchanged since last verified on {}, skipped'.format(
+            count, object_type, path, target.address))
+        name = '{}|skipped|ok'.format(object_type)
+        counts[name] = counts.get(name, 0) + count
+        return None
+    return fingerprint
+
+
+# Record the fingerprints verified on the targets synchronized successfully
+def save_fingerprints(state, targets):
+    if not state.settings['fingerprint_ttl']:
+        return
+    fingerprints = load_cache_file(state.logging, state.fingerprints_file)
+    now = time.time()
+    for target in targets:
+        known = fingerprints.setdefault(target.cluster_id, {})
+        for (object_type, path), fingerprint in target.verified.items():
+            known.setdefault(object_type, {})[path] = [fingerprint, now]
+        for paths in known.values():
+            for path in list(paths):
+                if path not in target.relationships:
+                    del paths[path]
+    write_atomically(state.fingerprints_file, json.dumps(fingerprints, sort_keys=True))
+
+
+# Replicate NFS exports and SMB shares of the primary cluster inventory to one target cluster and returns the
+# counts of results
+# With fingerprint_ttl, the object types of replicated paths unchanged since they were last verified are skipped
+def sync_target(state, target, inventory, snapshots):
+    settings = state.settings
+    logging = state.logging
+    metrics = state.metrics
+    scoped_inventory = scope_inventory(inventory, target.path_trie, target.path_translation)
+    # Objects moved from a replicated path to another are not deleted by mirror_deletes
+    kept_keys = {object_type: source_keys(inventory, object_type) if settings['mirror_deletes'] else set()
+                 for object_type in ('nfs', 'smb')}
+
+    # Replicate NFS exports and SMB shares related to each source path
+    # Records flow from the gather stage to the replication stage in memory, they are recorded in the versions
+    # directory of the target in the background if write_snapshots is set
+    # Only object types in sync_types are replicated
+    counts = {}
+    for path in target.path_translation:
+        # Get NFS exports related to this path
+        if 'nfs' in settings['sync_types']:
+            with metrics.phase('nfs'):
+                fingerprint = check_fingerprint(state, target, snapshots, 'nfs', path,
+                                                scoped_inventory[path]['nfs'], counts)
+                if fingerprint is not None:
+                    nfs_exports = snapshots.tap(get_nfs_exp(target.prc, logging, path, scoped_inventory[path]))
+                    results = replicate_nfs(target.src, logging, nfs_exports, path, target.path_trie,
+                                            target.target_snapshot, settings['replication_workers'],
+                                            settings['mirror_deletes'], target.applied, target.journal,
+                                            kept_keys['nfs'])
+                    count_path_results(target, path, results, counts)
+                    if fingerprint and all(result['status'] == 'ok' for result in results):
+                        target.verified[('nfs', path)] = fingerprint
+
+        # Get SMB Shares related to this path
+        if 'smb' in settings['sync_types']:
+            with metrics.phase('smb'):
+                fingerprint = check_fingerprint(state, target, snapshots, 'smb', path,
+                                                scoped_inventory[path]['smb'], counts)
+                if fingerprint is not None:
+                    smb_shares = snapshots.tap(get_smb_shr(target.prc, target.src, logging, path,
+                                                           scoped_inventory[path], target.identities))
+                    results = replicate_smb(target.src, logging, smb_shares, path, target.path_trie,
+                                            target.target_snapshot, settings['replication_workers'],
+                                            settings['mirror_deletes'], target.applied, target.journal,
+                                            kept_keys['smb'])
+                    count_path_results(target, path, results, counts)
+                    if fingerprint and all(result['status'] == 'ok' for result in results):
+                        target.verified[('smb', path)] = fingerprint
+    return counts
+
+
+# Returns True if settings limit synchronizations to some object types or replicated paths
+def is_partial_sync(settings):
+    return set(settings['sync_types']) != set(OBJECT_TYPES) or bool(settings['sync_paths'])
+
+
+# Fields of a relationship status that change when the relationship is modified or replicates
+ACTIVITY_FIELDS = ('id', 'target_address', 'target_port', 'target_root_path', 'state', 'end_reason', 'job_state',
+                   'job_start_time', 'recovery_point', 'error_from_last_job')
+
+
+# Returns the relationships as a sorted list of (id, source root, target root, target address), it changes when
+# a relationship is created, deleted or re-targeted
+def relationship_layout(all_repl):
+    return sorted((str(repl['id']), repl['source_root_path'], repl['target_root_path'], repl['target_address'])
+                  for repl in all_repl)
+
+
+# Returns a digest of the activity of the relationships of each replicated path of path_translation, every
+# relationship from the path to its target root is taken in account
+# A new, deleted or re-targeted relationship or a new replication job changes the digest of its path
+def relationship_activity(all_repl, path_translation):
+    statuses = {path: [] for path in path_translation}
+    for repl in all_repl:
+        if path_translation.get(repl['source_root_path']) == repl['target_root_path']:
+            statuses[repl['source_root_path']].append({field: repl.get(field) for field in ACTIVITY_FIELDS})
+    return {path: hashlib.sha1(json.dumps(sorted(path_statuses, key=lambda status: str(status['id'])),
+                                          sort_keys=True, default=str).encode()).hexdigest()
+            for path, path_statuses in statuses.items()}
+
+
+# Returns the content of a JSON state file of ./cache, empty if it does not exist or can not be read
+def load_cache_file(logging, path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as cache_json:
+            return json.load(cache_json)
+    except ValueError:
+        logging.error('load_cache_file, {} can not be read, every replicated path is synchronized'.format(path))
+        return {}
+
+
+# Record the relationships activity of the targets synchronized successfully, their idle replicated paths are
+# skipped by the next synchronizations ; paths with an object that failed are synchronized again next time
+# Nothing is recorded when sync_types leaves object types out, they were not synchronized
+def save_activity(state, targets):
+    if not state.settings['activity_gating'] or set(state.settings['sync_types']) != set(OBJECT_TYPES):
+        return
+    activity = load_cache_file(state.logging, state.activity_file)
+    for target in targets:
+        seen = activity.setdefault(target.cluster_id, {})
+        seen.update((path, digest) for path, digest in target.activity.items() if path not in target.failed_paths)
+        for path in list(seen):
+            if path not in target.relationships:
+                del seen[path]
+    write_atomically(state.activity_file, json.dumps(activity, sort_keys=True))
+
+
+# Retrieve replication relationships if needed and returns the targets with at least one replicated path to
+# synchronize
+# With activity_gating, relationship statuses are retrieved on each synchronization : relationships are
+# discovered again as soon as one is created, deleted or re-targeted, and replicated paths whose relationships
+# did not change since the last successful synchronization of the target are skipped
+def refresh_relationships(state):
+    settings = state.settings
+    logging = state.logging
+    state.connect_targets()
+    all_repl = None
+    with state.metrics.phase('discovery'):
+        if settings['activity_gating']:
+            all_repl = state.prc.replication.list_source_relationship_statuses()
+        if any(target.relationships is None for target in state.targets) or \
+                is_refresh_cycle(state.cycle, settings['relationships_refresh_cycles']) or \
+                (all_repl is not None and relationship_layout(all_repl) != state.relationship_layout):
+            path_translations = discover_relationships(state.prc, logging, state.targets, settings, all_repl)
+            state.relationship_layout = None if all_repl is None else relationship_layout(all_repl)
+            for target in state.targets:
+                target.relationships = path_translations[target.cluster_id]
+                # LOCAL users and groups translation is shared by every replicated path
+                target.identities = IdentityMap(target.prc, target.src, logging, settings['gather_workers'])
+                target.target_snapshot = None
+    activity = load_cache_file(logging, state.activity_file) if all_repl is not None else {}
+    for target in state.targets:
+        # Only the replicated paths matching sync_paths are synchronized
+        target.path_translation = select_roots(target.relationships, settings['sync_paths'])
+        if all_repl is not None:
+            target.activity = relationship_activity(all_repl, target.path_translation)
+            seen = activity.get(target.cluster_id, {})
+            idle = [path for path, digest in target.activity.items() if seen.get(path) == digest]
+            for path in idle:
+                del target.path_translation[path]
+            logging.info('refresh_relationships, {} replicated paths to {} did not replicate since the last '
+                         'synchronization and are skipped, {} are synchronized'.format(
+                             len(idle), target.address, len(target.path_translation)))
+        # Index replicated paths to match each object with its replicated path and translate it, objects of
+        # the paths left out are not synchronized with an enclosing replicated path
+        target.path_trie = build_path_trie(target.relationships, [path for path in target.relationships
+                                                                  if path not in target.path_translation])
+        if not target.path_translation:
+            logging.info('sync_cycle, No replicated path to synchronize to cluster {}, nothing to do'.format(
+                target.address))
+    return [target for target in state.targets if target.path_translation]
+
+
+# Run one synchronization of every replicated path to every target cluster and returns the number of objects
+# per type|action|status
+# The primary cluster inventory is retrieved once, then translated and applied to all targets concurrently,
+# quotas are streamed page by page
+# Relationships and target snapshots are only retrieved again every relationships_refresh_cycles and
+# target_refresh_cycles synchronizations, in between source objects already applied as is are skipped
+# REST calls and time spent are recorded per phase, the summary is written to metrics_file and prometheus_file
+def sync_cycle(state, date_suffix):
+    settings = state.settings
+    logging = state.logging
+    metrics = state.metrics
+    started = time.monotonic()
+    targets = refresh_relationships(state)
+    load_fingerprints(state)
+
+    # Objects written are journaled, objects an interrupted run already wrote are skipped if state.resume is set
+    done = state.journal.start(date_suffix, state.resume)
+    for target in state.targets:
+        target.resumed = done.get(target.cluster_id, {})
+        target.failed_paths = set()
+        target.journal = lambda entry, result, cluster_id=target.cluster_id: state.journal.record(cluster_id, entry,
+                                                                                                  result)
+    snapshots = {}
+    try:
+        # Retrieve target snapshots, targets that can not be retrieved are skipped, and SMB shares and NFS exports
+        # of the primary cluster once for all source paths and targets
+        outcomes, inventory = gather(state, targets)
+        failures = [err for target, result, err in outcomes if err is not None]
+        targets = [target for target, result, err in outcomes if err is None]
+
+        # Records are recorded in the versions directory of each target in the background if write_snapshots is set
+        # Runs limited by sync_types or sync_paths are not recorded, they would look like deletions of the rest, nor
+        # runs resuming an interrupted quotas enumeration as the quotas of its skipped pages are not retrieved
+        after = load_quota_cursor(state) if 'quotas' in settings['sync_types'] else None
+        snapshots = {target.address: SnapshotSink(logging, date_suffix,
+                                                  settings['write_snapshots'] and not is_partial_sync(settings) and
+                                                  after is None,
+                                                  settings['versions_keep_runs'], settings['versions_keep_days'],
+                                                  target.versions_path, settings['versions_compact_hours'])
+                     for target in targets}
+        # Replicated paths skipped by activity_gating are recorded as they were in the last recorded run
+        for target in targets:
+            for path in target.relationships:
+                if path not in target.path_translation:
+                    for object_type in settings['sync_types']:
+                        snapshots[target.address].carry(object_type, path)
+        counts = {}
+        failed = set()
+        if 'quotas' in settings['sync_types']:
+            with metrics.phase('quotas'):
+                failed = sync_quotas(state, targets, snapshots, counts, after)
+        for target, target_counts, err in run_on_targets(
+                state, [target for target in targets if target.address not in failed],
+                lambda target: sync_target(state, target, inventory, snapshots[target.address])):
+            if err is None:
+                for name, count in target_counts.items():
+                    counts[name] = counts.get(name, 0) + count
+            else:
+                failed.add(target.address)
+    except BaseException:
+        for sink in snapshots.values():
+            sink.discard()
+        # The next synchronization of this process resumes from the journal
+        state.journal.close(completed=False)
+        state.resume = True
+        raise
+    # Runs of failed targets are not recorded as they are incomplete
+    for target in targets:
+        if target.address in failed:
+            failures.append(ReplicationError('Synchronization of cluster {} failed'.format(target.address)))
+            snapshots[target.address].discard()
+        else:
+            snapshots[target.address].close()
+            target.src_paths.save()
+    state.journal.close(completed=not failures)
+    state.resume = bool(failures)
+    save_activity(state, [target for target in targets if target.address not in failed])
+    save_fingerprints(state, [target for target in targets if target.address not in failed])
+    if not failures:
+        state.verify = False
+
+    # Keep resolved paths for next run
+    state.prc_paths.save()
+    state.cycle += 1
+    state.last_metrics = metrics.summary(date_suffix, time.monotonic() - started, counts)
+    write_metrics(logging, state.last_metrics, settings['metrics_file'], settings['prometheus_file'])
+    if state.targets and len(failures) == len(state.targets):
+        raise failures[0]
+    return counts
+
+
+# REST calls made on the target cluster to apply a plan entry, per object type and action
+PLAN_CALLS = {
+    ('quotas', 'create'): ['quota.create_quota'],
+    ('quotas', 'update'): ['quota.update_quota'],
+    ('quotas', 'delete'): ['quota.delete_quota'],
+    ('nfs', 'create'): ['nfs.nfs_add_export'],
+    ('nfs', 'update'): ['nfs.nfs_modify_export'],
+    ('nfs', 'delete'): ['nfs.nfs_delete_export'],
+    ('smb', 'create'): ['smb.smb_add_share'],
+    ('smb', 'update'): ['smb.smb_modify_share'],
+    ('smb', 'delete'): ['smb.smb_delete_share'],
+}
+# Latency in seconds assumed for endpoints no previous run measured
+DEFAULT_LATENCY = 0.05
+
+
+# Returns the average latency of each endpoint measured by the last run, as (cluster, endpoint) -> seconds and
+# endpoint -> seconds over all clusters, from the metrics file written by sync_cycle
+def load_latencies(metrics_file):
+    per_cluster = {}
+    per_endpoint = {}
+    if not metrics_file or not os.path.exists(metrics_file):
+        return per_cluster, per_endpoint
+    with open(metrics_file) as metrics_json:
+        summary = json.load(metrics_json)
+    totals = {}
+    for ep in summary['endpoints']:
+        for key in ((ep['cluster'], ep['endpoint']), ep['endpoint']):
+            seconds, count = totals.get(key, (0.0, 0))
+            totals[key] = (seconds + ep['seconds'], count + ep['count'])
+    for key, (seconds, count) in totals.items():
+        if count:
+            (per_cluster if isinstance(key, tuple) else per_endpoint)[key] = seconds / count
+    return per_cluster, per_endpoint
+
+
+# Build the plan of a synchronization without writing anything on the target clusters
+# Returns, per target cluster, the number of objects to create, update, delete or leave unchanged per replicated
+# path and object type, every change, and the REST calls needed to apply them ; the estimated duration adds
+# the time spent retrieving everything (measured by this plan) to the time of the writes, estimated with the
+# latencies measured by the last run (metrics_file), writes being spread over replication_workers sessions
+def plan_cycle(state, date_suffix):
+    settings = state.settings
+    logging = state.logging
+    metrics = state.metrics
+    started = time.monotonic()
+    targets = refresh_relationships(state)
+    load_fingerprints(state)
+    outcomes, inventory = gather(state, targets)
+    targets = [target for target, result, err in outcomes if err is None]
+    plan = {'run': date_suffix, 'targets': {}}
+    for target, result, err in outcomes:
+        plan['targets'][target.address] = {'cluster_id': target.cluster_id, 'error': None if err is None else str(err),
+                                           'roots': {}, 'changes': [], 'calls': {}}
+
+    def add(target, entries):
+        target_plan = plan['targets'][target.address]
+        for entry in entries:
+            actions = target_plan['roots'].setdefault(entry['root'], {}).setdefault(entry['type'], {})
+            actions[entry['action']] = actions.get(entry['action'], 0) + 1
+            if entry['action'] == 'noop':
+                continue
+            calls = list(PLAN_CALLS[(entry['type'], entry['action'])])
+            # The target directory of a new quota is resolved first unless it is already known
+            if entry['type'] == 'quotas' and entry['action'] == 'create' and \
+                    entry['key'] not in target.src_paths.path_to_id:
+                calls.insert(0, 'fs.get_file_attr')
+            for endpoint in calls:
+                target_plan['calls'][endpoint] = target_plan['calls'].get(endpoint, 0) + 1
+            target_plan['changes'].append({'type': entry['type'], 'action': entry['action'], 'root': entry['root'],
+                                           'key': entry['key'], 'calls': calls})
+
+    # Objects unchanged since they were last verified on the target are skipped, see fingerprint_ttl
+    def unchanged(target, object_type, path, objects):
+        counts = {}
+        if check_fingerprint(state, target, SnapshotSink(logging, date_suffix, False), object_type, path, objects,
+                             counts) is not None:
+            return False
+        actions = plan['targets'][target.address]['roots'].setdefault(path, {}).setdefault(object_type, {})
+        actions['skipped'] = counts['{}|skipped|ok'.format(object_type)]
+        return True
+
+    with metrics.phase('quotas'):
+        kept = {target.address: {} for target in targets}
+        pages = prefetch(metrics, get_quota_pages(state.prc, logging, state.prc_paths, settings['quota_page_size'])) \
+            if 'quotas' in settings['sync_types'] else []
+        for cursor, quotas in pages:
+            for target in targets:
+                records = {}
+                for record in get_quotas(logging, target.path_trie, quotas):
+                    records.setdefault(record.root, []).append(record)
+                for path, path_records in records.items():
+                    add(target, plan_quotas(logging, path_records, path, target.path_trie, target.target_snapshot,
+                                            False, target.applied))
+                    kept[target.address].setdefault(path, set()).update(
+                        translate_path(target.path_trie, record.path)[1] for record in path_records)
+        if settings['mirror_deletes'] and 'quotas' in settings['sync_types']:
+            for target in targets:
+                for path in target.path_translation:
+                    add(target, plan_deletions('quotas', path, target.path_trie, target.target_snapshot,
+                                               kept[target.address].get(path, set()), None))
+    # Objects moved from a replicated path to another are not deleted by mirror_deletes
+    kept_keys = {object_type: source_keys(inventory, object_type) for object_type in ('nfs', 'smb')}
+    for target in targets:
+        scoped_inventory = scope_inventory(inventory, target.path_trie, target.path_translation)
+        for path in target.path_translation:
+            if 'nfs' in settings['sync_types']:
+                with metrics.phase('nfs'):
+                    if not unchanged(target, 'nfs', path, scoped_inventory[path]['nfs']):
+                        add(target, plan_nfs(logging, get_nfs_exp(target.prc, logging, path, scoped_inventory[path]),
+                                             path, target.path_trie, target.target_snapshot,
+                                             settings['mirror_deletes'], target.applied, kept_keys['nfs']))
+            if 'smb' in settings['sync_types']:
+                with metrics.phase('smb'):
+                    if not unchanged(target, 'smb', path, scoped_inventory[path]['smb']):
+                        add(target, plan_smb(logging, get_smb_shr(target.prc, target.src, logging, path,
+                                                                  scoped_inventory[path], target.identities),
+                                             path, target.path_trie, target.target_snapshot,
+                                             settings['mirror_deletes'], target.applied, kept_keys['smb']))
+
+    # Estimate the cost of the synchronization
+    read = metrics.summary(date_suffix, time.monotonic() - started, {})
+    per_cluster, per_endpoint = load_latencies(settings['metrics_file'])
+    write_seconds = 0.0
+    for address, target_plan in plan['targets'].items():
+        seconds = sum(count * per_cluster.get((address, endpoint), per_endpoint.get(endpoint, DEFAULT_LATENCY))
+                      for endpoint, count in target_plan['calls'].items())
+        target_plan['estimated_seconds'] = round(seconds / max(1, settings['replication_workers']), 3)
+        # Targets are written concurrently
+        write_seconds = max(write_seconds, target_plan['estimated_seconds'])
+    plan['estimate'] = {
+        'read_calls': sum(ep['count'] for ep in read['endpoints']),
+        'read_seconds': read['seconds'],
+        'write_calls': sum(sum(target_plan['calls'].values()) for target_plan in plan['targets'].values()),
+        'write_seconds': round(write_seconds, 3),
+        'seconds': round(read['seconds'] + write_seconds, 3),
+        'measured_latencies': bool(per_endpoint)}
+    return plan
+
+
+# Human readable summary of a plan built by plan_cycle
+def plan_summary(plan):
+    lines = []
+    for address, target_plan in plan['targets'].items():
+        lines.append('Target cluster {} ({})'.format(address, target_plan['cluster_id']))
+        if target_plan['error']:
+            lines.append('  can not be planned : {}'.format(target_plan['error']))
+            continue
+        for root, types in sorted(target_plan['roots'].items()):
+            lines.append('  {}'.format(root))
+            for object_type, actions in sorted(types.items()):
+                lines.append('    {:7} {}'.format(object_type, ', '.join(
+                    '{} {}'.format(actions.get(action, 0), action)
+                    for action in ('create', 'update', 'delete', 'noop', 'skipped') if actions.get(action))))
+        lines.append('  {} REST calls to apply the changes, about {}s'.format(
+            sum(target_plan['calls'].values()), target_plan['estimated_seconds']))
+    estimate = plan['estimate']
+    lines.append('Estimated synchronization : {} REST calls, about {}s ({} calls and {}s to retrieve the '
+                 'configuration, {} calls and {}s to apply the changes{})'.format(
+                     estimate['read_calls'] + estimate['write_calls'], estimate['seconds'], estimate['read_calls'],
+                     estimate['read_seconds'], estimate['write_calls'], estimate['write_seconds'],
+                     '' if estimate['measured_latencies'] else
+                     ', latencies not measured yet, {}s per call assumed'.format(DEFAULT_LATENCY)))
+    return '\n'.join(lines)
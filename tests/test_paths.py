@@ -0,0 +1,49 @@
+from q_functions import build_path_trie, scope_inventory, translate_path
+
+
+# Replicated roots : /data and /data/projects nested in it, /olddata shares the /data prefix
+PATH_TRANSLATION = {'/data/': '/dr/data/', '/data/projects/': '/dr/projects/', '/olddata/': '/dr/olddata/'}
+
+
+def test_translate_path_longest_match():
+    path_trie = build_path_trie(PATH_TRANSLATION)
+    assert translate_path(path_trie, '/data/x') == ('/data/', '/dr/data/x')
+    assert translate_path(path_trie, '/data/projects/x/y') == ('/data/projects/', '/dr/projects/x/y')
+    assert translate_path(path_trie, '/data/projectsold/x') == ('/data/', '/dr/data/projectsold/x')
+
+
+def test_translate_path_matches_whole_components():
+    path_trie = build_path_trie(PATH_TRANSLATION)
+    assert translate_path(path_trie, '/olddata/x') == ('/olddata/', '/dr/olddata/x')
+    assert translate_path(path_trie, '/dataset/x') == (None, None)
+    assert translate_path(path_trie, '/other/data/x') == (None, None)
+
+
+def test_translate_path_trailing_slash():
+    path_trie = build_path_trie({'/data': '/dr/data'})
+    assert translate_path(path_trie, '/data/x/') == ('/data', '/dr/data/x/')
+    assert translate_path(path_trie, '/data/x') == ('/data', '/dr/data/x')
+    assert translate_path(path_trie, '/data/') == ('/data', '/dr/data/')
+    assert translate_path(path_trie, '/data') == ('/data', '/dr/data')
+    assert translate_path(path_trie, '//data//x') == ('/data', '/dr/data/x')
+
+
+def test_translate_path_root_replicated():
+    path_trie = build_path_trie({'/': '/dr/'})
+    assert translate_path(path_trie, '/x/y') == ('/', '/dr/x/y')
+    assert translate_path(path_trie, '/') == ('/', '/dr/')
+
+
+def test_translate_path_excluded_nested_root():
+    path_trie = build_path_trie(PATH_TRANSLATION, excluded=['/data/projects/'])
+    assert translate_path(path_trie, '/data/projects/x') == (None, None)
+    assert translate_path(path_trie, '/data/x') == ('/data/', '/dr/data/x')
+
+
+def test_scope_inventory_longest_root():
+    path_trie = build_path_trie(PATH_TRANSLATION)
+    inventory = {'nfs': {'/data/x': ['x'], '/data/projects/y': ['y'], '/olddata/z': ['z'], '/other/w': ['w']}}
+    scoped = scope_inventory(inventory, path_trie, PATH_TRANSLATION)
+    assert scoped == {'/data/': {'nfs': {'/data/x': ['x']}},
+                      '/data/projects/': {'nfs': {'/data/projects/y': ['y']}},
+                      '/olddata/': {'nfs': {'/olddata/z': ['z']}}}
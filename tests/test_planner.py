@@ -0,0 +1,89 @@
+import logging
+
+from q_fake_rest import FakeCluster, FakeRestClient
+from q_functions import ConfigRecord, build_path_trie, get_target_snapshot, plan_nfs, plan_quotas, \
+    update_target_snapshot
+
+
+PATH_TRANSLATION = {'/a/': '/dr/a/', '/b/': '/dr/b/'}
+
+
+def export(export_path, fs_path, description=''):
+    return {'export_path': export_path, 'fs_path': fs_path, 'description': description,
+            'fields_to_present_as_32_bit': [],
+            'restrictions': [{'read_only': False, 'require_privileged_port': False, 'host_restrictions': [],
+                              'user_mapping': 'NFS_MAP_NONE', 'map_to_user': {'id_type': 'LOCAL_USER',
+                                                                              'id_value': '0'}}]}
+
+
+# Target cluster with exports under /dr/a/ and its snapshot
+def target_snapshot(exports):
+    cluster = FakeCluster('target', '10.0.1.1')
+    for obj in exports:
+        export_id = cluster.new_id()
+        cluster.exports[export_id] = dict(obj, id=export_id)
+    return get_target_snapshot(FakeRestClient(cluster), logging, None, PATH_TRANSLATION, types=('nfs',))
+
+
+def actions(plan):
+    return {entry['key']: entry['action'] for entry in plan}
+
+
+def test_plan_nfs_create_update_noop():
+    path_trie = build_path_trie(PATH_TRANSLATION)
+    snapshot = target_snapshot([export('/same', '/dr/a/same'), export('/diff', '/dr/a/diff', 'old')])
+    records = [ConfigRecord('nfs', '/a/', obj['export_path'], obj['fs_path'], obj)
+               for obj in (export('/new', '/a/new'), export('/same', '/a/same'), export('/diff', '/a/diff', 'new'))]
+    plan = plan_nfs(logging, records, '/a/', path_trie, snapshot)
+    assert actions(plan) == {'/new': 'create', '/same': 'noop', '/diff': 'update'}
+    assert [entry['source']['fs_path'] for entry in plan] == ['/dr/a/new', '/dr/a/same', '/dr/a/diff']
+
+
+def test_plan_nfs_mirror_deletes():
+    path_trie = build_path_trie(PATH_TRANSLATION)
+    snapshot = target_snapshot([export('/same', '/dr/a/same'), export('/gone', '/dr/a/gone'),
+                                export('/moved', '/dr/a/moved'), export('/other', '/dr/b/other')])
+    records = [ConfigRecord('nfs', '/a/', '/same', '/a/same', export('/same', '/a/same'))]
+    assert actions(plan_nfs(logging, records, '/a/', path_trie, snapshot)) == {'/same': 'noop'}
+    # /moved is now under /b/ on the primary cluster, it is updated there instead of being deleted
+    plan = plan_nfs(logging, records, '/a/', path_trie, snapshot, mirror_deletes=True,
+                    source_keys={'/same', '/moved'})
+    assert actions(plan) == {'/same': 'noop', '/gone': 'delete'}
+    assert plan[-1]['target']['fs_path'] == '/dr/a/gone'
+
+
+def test_plan_nfs_already_applied():
+    path_trie = build_path_trie(PATH_TRANSLATION)
+    snapshot = target_snapshot([export('/diff', '/dr/a/diff', 'old')])
+    record = ConfigRecord('nfs', '/a/', '/diff', '/a/diff', export('/diff', '/a/diff', 'new'))
+    applied = {}
+    plan = plan_nfs(logging, [record], '/a/', path_trie, snapshot, applied=applied)
+    assert actions(plan) == {'/diff': 'update'}
+    applied[('nfs', '/a/', '/diff')] = plan[0]['digest']
+    assert actions(plan_nfs(logging, [record], '/a/', path_trie, snapshot, applied=applied)) == {'/diff': 'noop'}
+
+
+def test_plan_quotas():
+    path_trie = build_path_trie(PATH_TRANSLATION)
+    snapshot = {'quotas': {'/dr/a/same/': {'id': '1', 'limit': '10'}, '/dr/a/diff/': {'id': '2', 'limit': '10'},
+                           '/dr/a/gone/': {'id': '3', 'limit': '10'}},
+                'roots': {'/dr/a/': {'quotas': {'/dr/a/same/': [{'id': '1', 'limit': '10'}],
+                                                '/dr/a/diff/': [{'id': '2', 'limit': '10'}],
+                                                '/dr/a/gone/': [{'id': '3', 'limit': '10'}]}}}}
+    records = [ConfigRecord('quotas', '/a/', path, path, {'id': path, 'limit': limit})
+               for path, limit in (('/a/new/', 10), ('/a/same/', 10), ('/a/diff/', 20))]
+    plan = plan_quotas(logging, records, '/a/', path_trie, snapshot, mirror_deletes=True)
+    assert actions(plan) == {'/dr/a/new/': 'create', '/dr/a/same/': 'noop', '/dr/a/diff/': 'update',
+                             '/dr/a/gone/': 'delete'}
+
+
+def test_update_target_snapshot_moves_object():
+    path_trie = build_path_trie(PATH_TRANSLATION)
+    snapshot = target_snapshot([export('/moved', '/dr/a/moved')])
+    record = ConfigRecord('nfs', '/b/', '/moved', '/b/moved', export('/moved', '/b/moved'))
+    entry = plan_nfs(logging, [record], '/b/', path_trie, snapshot)[0]
+    assert entry['action'] == 'update'
+    update_target_snapshot(snapshot, entry, {'id': None})
+    assert snapshot['roots']['/dr/a/']['nfs'] == {'/dr/a/moved': []}
+    assert [obj['fs_path'] for obj in snapshot['roots']['/dr/b/']['nfs']['/dr/b/moved']] == ['/dr/b/moved']
+    assert snapshot['nfs']['/moved']['fs_path'] == '/dr/b/moved'
@@ -0,0 +1,88 @@
+import http.client
+import logging
+
+import pytest
+from qumulo.rest_client import RestClient
+
+from q_fake_rest import FakeCluster, FakeRestClient
+from q_functions import RunMetrics, Transport, classify_error, load_settings
+
+
+def test_classify_error():
+    assert classify_error(RestClient.Error(404, 'Not Found')) == 'not_found'
+    for status_code in (429, 502, 503, 504):
+        assert classify_error(RestClient.Error(status_code, 'Busy')) == 'transient'
+    assert classify_error(ConnectionResetError()) == 'unreachable'
+    assert classify_error(TimeoutError()) == 'unreachable'
+    assert classify_error(http.client.RemoteDisconnected()) == 'unreachable'
+    assert classify_error(RestClient.Error(400, 'Bad Request')) == 'fatal'
+    assert classify_error(RestClient.Error(409, 'Conflict')) == 'fatal'
+    assert classify_error(ValueError()) == 'fatal'
+
+
+# Request failing with errors, then returning 'ok'
+def failing(*errors):
+    calls = []
+
+    def request():
+        calls.append(None)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return 'ok'
+    return request, calls
+
+
+def transport(retries=3):
+    settings = load_settings({'retries': retries, 'retry_base_delay': 0, 'retry_max_delay': 0})
+    metrics = RunMetrics()
+    return Transport(FakeRestClient(FakeCluster('c', '10.0.0.1')), logging, metrics, settings), metrics
+
+
+def test_transient_errors_are_retried():
+    rest, metrics = transport()
+    request, calls = failing(RestClient.Error(503, 'Busy'), RestClient.Error(429, 'Busy'))
+    assert rest.call('nfs.nfs_list_exports', lambda: 'gather', request) == 'ok'
+    assert len(calls) == 3
+    stats = metrics.summary('run', 0, {})['endpoints'][0]
+    assert stats['count'] == 3 and stats['errors'] == {'503': 1, '429': 1}
+
+
+def test_retries_are_bounded():
+    rest, metrics = transport(retries=2)
+    request, calls = failing(*[RestClient.Error(503, 'Busy')] * 5)
+    with pytest.raises(RestClient.Error):
+        rest.call('nfs.nfs_list_exports', lambda: 'gather', request)
+    assert len(calls) == 3
+
+
+def test_fatal_errors_are_not_retried():
+    rest, metrics = transport()
+    for err in (RestClient.Error(404, 'Not Found'), RestClient.Error(409, 'Conflict')):
+        request, calls = failing(err)
+        with pytest.raises(RestClient.Error):
+            rest.call('smb.smb_modify_share', lambda: 'smb', request)
+        assert len(calls) == 1
+
+
+def test_connection_failures_only_retried_when_safe():
+    rest, metrics = transport()
+    request, calls = failing(ConnectionResetError())
+    assert rest.call('nfs.nfs_modify_export', lambda: 'nfs', request) == 'ok'
+    assert len(calls) == 2
+    # A creation may have been applied before the connection was lost
+    request, calls = failing(ConnectionResetError())
+    with pytest.raises(ConnectionResetError):
+        rest.call('nfs.nfs_add_export', lambda: 'nfs', request)
+    assert len(calls) == 1
+    # Busy clusters did not apply the request, creations are retried
+    request, calls = failing(RestClient.Error(503, 'Busy'))
+    assert rest.call('quota.create_quota', lambda: 'quotas', request) == 'ok'
+    assert len(calls) == 2
+
+
+def test_overloaded_cluster_halves_concurrency():
+    rest, metrics = transport()
+    limit = rest.governor.limit
+    request, calls = failing(RestClient.Error(503, 'Busy'))
+    rest.call('nfs.nfs_list_exports', lambda: 'gather', request)
+    assert rest.governor.limit == limit // 2